@@ -0,0 +1,35 @@
+"""
+Benchmark of the chunked bandpass filter on synthetic data.
+
+Usage: python bench_bandpass_filter.py [num_channels] [num_chunks]
+"""
+import sys
+import time
+import numpy as np
+import spikeextractors as se
+import spiketoolkit as st
+
+
+def bench_bandpass_filter(num_channels=384, num_chunks=10, chunk_size=30000, sampling_frequency=30000.,
+                          **filter_kwargs):
+    timeseries = np.random.RandomState(0).randn(num_channels, num_chunks * chunk_size).astype('float32')
+    recording = se.NumpyRecordingExtractor(timeseries=timeseries, sampling_frequency=sampling_frequency)
+    recording_f = st.preprocessing.bandpass_filter(recording, chunk_size=chunk_size, **filter_kwargs)
+    t_start = time.perf_counter()
+    for i in range(num_chunks):
+        recording_f.get_traces(start_frame=i * chunk_size, end_frame=(i + 1) * chunk_size)
+    elapsed = time.perf_counter() - t_start
+    return num_chunks / elapsed
+
+
+if __name__ == '__main__':
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 384
+    num_chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for filter_type in ['fft', 'butter']:
+        for compute_dtype in ['float64', 'float32']:
+            chunks_per_s = bench_bandpass_filter(num_channels=num_channels, num_chunks=num_chunks,
+                                                 filter_type=filter_type, compute_dtype=compute_dtype)
+            print(f"{filter_type} ({compute_dtype}): {num_channels} channels - {chunks_per_s:.2f} chunks/s")
+    chunks_per_s = bench_bandpass_filter(num_channels=num_channels, num_chunks=num_chunks, filter_type='fft',
+                                         fft_workers=-1)
+    print(f"fft (all fft workers): {num_channels} channels - {chunks_per_s:.2f} chunks/s")
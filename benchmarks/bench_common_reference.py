@@ -0,0 +1,31 @@
+"""
+Benchmark of the reference kernels of the common median reference on synthetic data.
+
+Usage: python bench_common_reference.py [num_chunks]
+"""
+import sys
+import time
+import numpy as np
+import spikeextractors as se
+import spiketoolkit as st
+
+
+def bench_common_reference(num_channels=384, num_chunks=10, chunk_size=30000, sampling_frequency=30000.,
+                           **reference_kwargs):
+    timeseries = np.random.RandomState(0).randn(num_channels, num_chunks * chunk_size).astype('float32') * 20
+    recording = se.NumpyRecordingExtractor(timeseries=timeseries, sampling_frequency=sampling_frequency)
+    recording_cmr = st.preprocessing.common_reference(recording, reference='median', **reference_kwargs)
+    t_start = time.perf_counter()
+    for i in range(num_chunks):
+        recording_cmr.get_traces(start_frame=i * chunk_size, end_frame=(i + 1) * chunk_size)
+    elapsed = time.perf_counter() - t_start
+    return num_chunks / elapsed
+
+
+if __name__ == '__main__':
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for num_channels in [64, 384, 1024]:
+        for median_kernel in ['exact', 'partition', 'trimmed_mean', 'approximate']:
+            chunks_per_s = bench_common_reference(num_channels=num_channels, num_chunks=num_chunks,
+                                                  median_kernel=median_kernel)
+            print(f"{median_kernel}: {num_channels} channels - {chunks_per_s:.2f} chunks/s")
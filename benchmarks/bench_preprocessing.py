@@ -0,0 +1,133 @@
+"""
+Throughput benchmark of all the preprocessors and of common preprocessing chains on synthetic data.
+
+For each preprocessor (or chain), channel count, chunk size and dtype, the recording is read chunk by chunk and the
+throughput (MB/s of input traces) and the peak memory allocated while reading one chunk are reported. Results can be
+saved to a csv file to compare runs.
+
+Usage: python bench_preprocessing.py [--channels 32 384 1024] [--chunk-sizes 30000] [--dtypes float32 int16]
+                                     [--duration 10] [--only BandpassFilter bandpass+cmr] [--output results.csv]
+"""
+import argparse
+import csv
+import time
+import tracemalloc
+import numpy as np
+import spikeextractors as se
+import spiketoolkit as st
+import spiketoolkit.preprocessing as stp
+
+
+def generate_recording(num_channels, duration, sampling_frequency=30000., dtype='float32', seed=0):
+    """Noise with a common component, line noise and a few saturated segments on a 2-column probe"""
+    rs = np.random.RandomState(seed)
+    num_frames = int(duration * sampling_frequency)
+    times = np.arange(num_frames) / sampling_frequency
+    timeseries = 20 * rs.randn(num_channels, num_frames).astype('float32')
+    timeseries += 10 * rs.randn(1, num_frames).astype('float32')
+    timeseries += (15 * np.sin(2 * np.pi * 50 * times)).astype('float32')
+    for start in rs.randint(0, num_frames - 100, size=5):
+        timeseries[:, start:start + 100] = 1000
+    if np.dtype(dtype).kind == 'i':
+        timeseries = np.round(timeseries).astype(dtype)
+    recording = se.NumpyRecordingExtractor(timeseries=timeseries, sampling_frequency=sampling_frequency)
+    recording.set_channel_locations(np.array([[20 * (ch % 2), 20 * (ch // 2)] for ch in range(num_channels)]))
+    return recording
+
+
+def get_benchmarks(recording, chunk_size):
+    """Returns the functions building the benchmarked recordings, by preprocessor name or chain name"""
+    fs = recording.get_sampling_frequency()
+    num_frames = recording.get_num_frames()
+    triggers = list(np.arange(int(fs // 10), num_frames, int(fs // 10)))
+    bool_mask = np.zeros(num_frames, dtype=bool)
+    bool_mask[::100] = True
+    filter_kwargs = dict(chunk_size=chunk_size)
+    benchmarks = {
+        'BandpassFilter': lambda rec: stp.bandpass_filter(rec, **filter_kwargs),
+        'HighpassFilter': lambda rec: stp.highpass_filter(rec, **filter_kwargs),
+        'NotchFilter': lambda rec: stp.notch_filter(rec, freq=50, **filter_kwargs),
+        'Whiten': lambda rec: stp.whiten(rec, **filter_kwargs),
+        'CommonReference': lambda rec: stp.common_reference(rec, reference='median'),
+        'Resample': lambda rec: stp.resample(rec, resample_rate=fs / 3, **filter_kwargs),
+        'Rectify': lambda rec: stp.rectify(rec),
+        'RemoveArtifacts': lambda rec: stp.remove_artifacts(rec, triggers=triggers, mode='linear'),
+        'RemoveBadChannels': lambda rec: stp.remove_bad_channels(rec, bad_channel_ids=[0]),
+        'Transform': lambda rec: stp.transform(rec, scalar=2, offset=1),
+        'NormalizeByQuantile': lambda rec: stp.normalize_by_quantile(rec),
+        'Clip': lambda rec: stp.clip(rec, a_min=-100, a_max=100),
+        'BlankSaturation': lambda rec: stp.blank_saturation(rec),
+        'Center': lambda rec: stp.center(rec),
+        'Mask': lambda rec: stp.mask(rec, bool_mask=bool_mask),
+        'Fuse': lambda rec: stp.fuse(stp.clip(stp.transform(rec, scalar=2, offset=1), a_min=-100, a_max=100),
+                                  chunk_size=chunk_size),
+        'Prefetch': lambda rec: stp.prefetch(rec),
+        # common chains
+        'bandpass+cmr': lambda rec: stp.common_reference(stp.bandpass_filter(rec, **filter_kwargs)),
+        'highpass+cmr+whiten': lambda rec: stp.whiten(stp.common_reference(stp.highpass_filter(rec, **filter_kwargs)),
+                                                      **filter_kwargs),
+        'bandpass+cmr (fused)': lambda rec: stp.fuse(stp.common_reference(stp.bandpass_filter(rec, **filter_kwargs)),
+                                                     chunk_size=chunk_size),
+        'notch+bandpass+cmr (prefetch)': lambda rec: stp.prefetch(stp.common_reference(stp.bandpass_filter(
+            stp.notch_filter(rec, freq=50, **filter_kwargs), **filter_kwargs))),
+    }
+    missing = [pp.preprocessor_name for pp in stp.preprocessers_full_list if pp.preprocessor_name not in benchmarks]
+    assert len(missing) == 0, f"Preprocessors without benchmark: {missing}"
+    return benchmarks
+
+
+def bench_recording(build, recording, chunk_size):
+    """Returns the initialization time, the throughput in MB/s of input traces and the peak memory of one chunk"""
+    t_start = time.perf_counter()
+    recording_pp = build(recording)
+    init_time = time.perf_counter() - t_start
+
+    num_frames = recording_pp.get_num_frames()
+    t_start = time.perf_counter()
+    for start_frame in range(0, num_frames, chunk_size):
+        recording_pp.get_traces(start_frame=start_frame, end_frame=min(start_frame + chunk_size, num_frames))
+    elapsed = time.perf_counter() - t_start
+    num_mb = recording.get_num_channels() * recording.get_num_frames() * np.dtype(recording.get_dtype()).itemsize / 1e6
+
+    # numpy allocations are traced by tracemalloc
+    start_frame = (num_frames // chunk_size // 2) * chunk_size
+    tracemalloc.start()
+    recording_pp.get_traces(start_frame=start_frame, end_frame=min(start_frame + chunk_size, num_frames))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return init_time, num_mb / elapsed, peak / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, nargs='+', default=[32, 384, 1024])
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[30000])
+    parser.add_argument('--dtypes', nargs='+', default=['float32', 'int16'])
+    parser.add_argument('--duration', type=float, default=10., help='Duration of the recordings in seconds')
+    parser.add_argument('--only', nargs='+', default=None, help='Names of the preprocessors or chains to run')
+    parser.add_argument('--output', default=None, help='csv file to save the results')
+    args = parser.parse_args()
+
+    results = []
+    print(f"spiketoolkit {st.__version__}")
+    print(f"{'benchmark':32s} {'channels':>8s} {'chunk':>7s} {'dtype':>8s} {'init (s)':>9s} {'MB/s':>9s} "
+          f"{'peak MB':>9s}")
+    for num_channels in args.channels:
+        for dtype in args.dtypes:
+            recording = generate_recording(num_channels, args.duration, dtype=dtype)
+            for chunk_size in args.chunk_sizes:
+                for name, build in get_benchmarks(recording, chunk_size).items():
+                    if args.only is not None and name not in args.only:
+                        continue
+                    init_time, mb_per_s, peak_mb = bench_recording(build, recording, chunk_size)
+                    print(f"{name:32s} {num_channels:8d} {chunk_size:7d} {dtype:>8s} {init_time:9.2f} "
+                          f"{mb_per_s:9.1f} {peak_mb:9.1f}")
+                    results.append({'benchmark': name, 'num_channels': num_channels, 'chunk_size': chunk_size,
+                                    'dtype': dtype, 'init_time': init_time, 'mb_per_s': mb_per_s,
+                                    'peak_mb': peak_mb})
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
@@ -1347,7 +1347,9 @@ def export_to_phy(recording, sorting, output_folder, compute_pc_features=True,
 
     if copy_binary:
         rec_path = 'recording.dat'  # Use relative path in this case
-        recording.write_to_binary_dat_format(output_folder / rec_path, dtype=dtype)
+        n_jobs = params_dict['n_jobs'] if params_dict['n_jobs'] is not None else 1
+        st.preprocessing.write_binary(recording, output_folder / rec_path, dtype=dtype, n_jobs=n_jobs,
+                                      joblib_backend=params_dict['joblib_backend'], verbose=verbose)
     elif isinstance(recording, se.CacheRecordingExtractor):
         rec_path = str(Path(recording.filename).absolute())
         dtype = recording.get_dtype()
@@ -1 +1,6 @@
 from .preprocessinglist import *
+from .filterrecording import get_shared_chunk_cache, set_filter_threads
+from .recording_stats import get_recording_stats, get_quantile_sketch, RecordingStats, QuantileSketch, \
+    set_recording_stats_cache_mb, clear_recording_stats_cache
+from .write_binary import write_binary
+from .profiling import profile_preprocessing, get_active_profiler, PreprocessingProfiler
@@ -1,6 +1,8 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, check_sos_stability, get_sos_padding, get_kernel_padding
+from functools import lru_cache
 import numpy as np
 import scipy.signal as ss
+import scipy.fft as sfft
 from scipy import special
 import spikeextractors as se
 
@@ -9,58 +11,69 @@ class BandpassFilterRecording(FilterRecording):
     preprocessor_name = 'BandpassFilter'
 
     def __init__(self, recording, freq_min=300, freq_max=6000, freq_wid=1000, filter_type='fft', order=3,
-                 chunk_size=30000, cache_chunks=False, dtype=None):
+                 chunk_size=30000, cache_chunks=False, cache_mb=None, cache_folder=None, fft_workers=1,
+                 compute_dtype='float64', causal=False, padding_tol=1e-5, dtype=None):
         self._freq_min = freq_min
         self._freq_max = freq_max
         self._freq_wid = freq_wid
         self._type = filter_type
         self._order = order
         self._chunk_size = chunk_size
+        self._fft_workers = fft_workers
+        self._padding_tol = padding_tol
 
+        # the padding covers the impulse response of the filter (at most 1 s)
+        max_padding = int(recording.get_sampling_frequency())
         if self._type == 'butter':
             fn = recording.get_sampling_frequency() / 2.
             band = np.array([self._freq_min, self._freq_max]) / fn
 
-            self._b, self._a = ss.butter(self._order, band, btype='bandpass')
-
-            if not np.all(np.abs(np.roots(self._a)) < 1):
-                raise ValueError('Filter is not stable')
+            # second-order sections are numerically stable also for high orders
+            self._sos = ss.butter(self._order, band, btype='bandpass', output='sos')
+            check_sos_stability(self._sos)
+            self._padding = get_sos_padding(self._sos, max_padding, tol=padding_tol)
+        else:
+            kernel = _get_filter_kernel(2 * max_padding, recording.get_sampling_frequency(), self._freq_min,
+                                        self._freq_max, self._freq_wid)
+            self._padding = get_kernel_padding(kernel, tol=padding_tol)
         FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
-                                 dtype=dtype)
+                                 cache_mb=cache_mb, cache_folder=cache_folder,
+                                 compute_dtype=compute_dtype, causal=causal, dtype=dtype)
         self.is_filtered = True
         self._kwargs = {'recording': recording.make_serialized_dict(), 'freq_min': freq_min, 'freq_max': freq_max,
                         'freq_wid': freq_wid, 'filter_type': filter_type, 'order': order,
-                        'chunk_size': chunk_size, 'cache_chunks': cache_chunks}
-
-    def filter_chunk(self, start_frame, end_frame, channel_ids, return_scaled):
-        padding = 3000
-        i1 = start_frame - padding
-        i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2, channel_ids, return_scaled)
-        filtered_padded_chunk = self._do_filter(padded_chunk)
-        return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
+                        'chunk_size': chunk_size, 'cache_chunks': cache_chunks, 'cache_mb': cache_mb,
+                        'cache_folder': cache_folder, 'fft_workers': fft_workers,
+                        'compute_dtype': compute_dtype, 'causal': causal,
+                        'padding_tol': padding_tol}
 
     def _do_filter(self, chunk):
         sampling_frequency = self._recording.get_sampling_frequency()
-        M = chunk.shape[0]
         chunk2 = chunk
         # Do the actual filtering with a DFT with real input
         if self._type == 'fft':
-            chunk_fft = np.fft.rfft(chunk2)
-            kernel = _create_filter_kernel(
-                chunk2.shape[1],
-                sampling_frequency,
-                self._freq_min, self._freq_max, self._freq_wid
-            )
-            kernel = kernel[0:chunk_fft.shape[1]]  # because this is the DFT of real data
-            chunk_fft = chunk_fft * np.tile(kernel, (M, 1))
-            chunk_filtered = np.fft.irfft(chunk_fft)
+            # the DFT is computed on a fast length (the zero padding only affects the discarded edges)
+            n = chunk2.shape[1]
+            nfft = sfft.next_fast_len(n, real=True)
+            chunk_fft = sfft.rfft(chunk2, n=nfft, axis=1, workers=self._fft_workers)
+            chunk_fft *= _get_filter_kernel(nfft, sampling_frequency, self._freq_min, self._freq_max,
+                                            self._freq_wid)
+            chunk_filtered = sfft.irfft(chunk_fft, n=nfft, axis=1, workers=self._fft_workers)[:, :n]
         elif self._type == 'butter':
-            chunk_filtered = ss.filtfilt(self._b, self._a, chunk2, axis=1)
+            chunk_filtered = self._apply_sos(chunk2)
 
         return chunk_filtered
 
 
+@lru_cache(maxsize=32)
+def _get_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid):
+    # kernels are cached by length and only contain the positive frequencies (DFT of real data)
+    kernel = _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid)
+    kernel = kernel[0:N // 2 + 1]
+    kernel.flags.writeable = False
+    return kernel
+
+
 def _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid=1000):
     # Matches ahb's code /matlab/processors/ms_bandpass_filter.m
     # improved ahb, changing tanh to erf, correct -3dB pts  6/14/16
@@ -85,7 +98,8 @@ def _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid=10
 
 
 def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, filter_type='fft', order=3,
-                    chunk_size=30000, cache_chunks=False, dtype=None):
+                    chunk_size=30000, cache_chunks=False, cache_mb=None, cache_folder=None, fft_workers=1,
+                    compute_dtype='float64', causal=False, padding_tol=1e-5, dtype=None):
     '''
     Performs a lazy filter on the recording extractor traces.
 
@@ -101,13 +115,34 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, filte
         Width of the filter (when type is 'fft').
     filter_type: str
         'fft' or 'butter'. The 'fft' filter uses a kernel in the frequency domain. The 'butter' filter uses
-        scipy butter and filtfilt functions.
+        scipy butter (as second-order sections) and sosfiltfilt
+        functions.
     order: int
         Order of the filter (if 'butter').
     chunk_size: int
         The chunk size to be used for the filtering.
-    cache_chunks: bool (default False).
-        If True then each chunk is cached in memory (in a dict)
+    cache_chunks: bool or 'shared' (default False).
+        If True then each chunk is cached in memory in a least-recently-used cache of 'cache_mb' Mb.
+        If 'shared', chunks are cached in the process-wide cache shared by all filter recordings
+    cache_mb: float or None
+        Memory budget in Mb of the chunk cache when cache_chunks is True (default 800 Mb)
+    cache_folder: str, Path, or None
+        If given, filtered chunks are also cached on disk in a sub-folder of 'cache_folder' identified by the hash of
+        the preprocessing chain, so that they are reused by other processes (the recording must be dumpable)
+    fft_workers: int
+        Number of threads used by scipy.fft (when type is 'fft'). If -1, all available cores are used (default 1)
+    compute_dtype: dtype
+        The dtype used for the filtering computations: 'float64' (default) or 'float32', which halves the memory
+        traffic per chunk
+    causal: bool
+        If True (only when type is 'butter'), the filter is applied forward only (sosfilt) instead of forward-backward
+        (sosfiltfilt). When chunks are read in order, the filter state is carried between consecutive chunks so that
+        no padding is read, which halves the cost per chunk at the price of a non-zero phase response
+    padding_tol: float
+        The padding read on each side of a chunk is the length after which the tail of the filter impulse response
+        has a sum of absolute values below 'padding_tol' times the sum of absolute values of the impulse response
+        (capped to 1 s). Each filter pass on a chunk then differs from the unchunked filtering by at most
+        'padding_tol' times that sum times the maximum absolute value of the traces (default 1e-5)
     dtype: dtype
         The dtype of the traces
 
@@ -125,6 +160,12 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, filte
         order=order,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
+        cache_mb=cache_mb,
+        cache_folder=cache_folder,
+        fft_workers=fft_workers,
+        compute_dtype=compute_dtype,
+        causal=causal,
+        padding_tol=padding_tol,
         dtype=dtype
     )
     return bpf_recording
@@ -1,10 +1,22 @@
 from spikeextractors import RecordingExtractor
 from spikeextractors.extraction_tools import check_get_traces_args
+from .profiling import profiled
+import numpy as np
 
 
 class BasePreprocessorRecordingExtractor(RecordingExtractor):
     installed = True  # check at class level if installed or not
     installation_mesg = ""  # err
+    _fusable = False  # True if the stage can be compiled in a FusedRecording plan (see fuse.py)
+    _mixes_channels = False  # True if the output of a channel depends on other channels
+    _elementwise = False  # True if the stage is applied sample by sample in place (see _get_elementwise_traces)
+    _chunk_statistics = False  # True if the stage output depends on statistics of its chunks (e.g. whitening mean)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # get_traces calls are recorded when profiling is enabled (see profiling.py)
+        if 'get_traces' in cls.__dict__:
+            cls.get_traces = profiled(cls.__dict__['get_traces'])
 
     def __init__(self, recording, copy_times=True):
         assert isinstance(recording, RecordingExtractor), "'recording' must be a RecordingExtractor"
@@ -44,3 +56,100 @@ class BasePreprocessorRecordingExtractor(RecordingExtractor):
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
         raise NotImplementedError
 
+    def _fused_padding(self):
+        # number of samples needed on each side of a block to compute the stage output
+        return 0
+
+    def _fused_compute_dtype(self):
+        # dtype in which the stage computes its output
+        return 'float32'
+
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        # applies the stage to a (scaled) block of parent traces starting at 'start_frame' (it can be negative or
+        # exceed the number of frames when the block is padded). Operating in place is allowed.
+        raise NotImplementedError
+
+    def _get_elementwise_traces(self, channel_ids, start_frame, end_frame, return_scaled=True, out=None):
+        # the run of consecutive element-wise stages ending with this one is applied in place on a single buffer,
+        # which is 'out' if given (and of the compute dtype)
+        stages = []
+        source = self
+        while isinstance(source, BasePreprocessorRecordingExtractor) and source._elementwise:
+            stages.append(source)
+            source = source._recording
+        stages = stages[::-1]
+        # as when the stages are called one by one, a stage without unscaled traces (e.g. transform, which only
+        # supports return_scaled=True) makes the stages below it return scaled traces
+        if not return_scaled and not all(stage.has_unscaled for stage in stages):
+            return_scaled = True
+        traces = source.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame,
+                                   return_scaled=return_scaled)
+
+        # same dtypes as the stages applied one by one (e.g. float32 stays float32 and int16 is computed in float64)
+        compute_dtype = np.result_type(traces.dtype, 1.)
+        out_dtype = traces.dtype
+        for stage in stages:
+            out_dtype = stage._get_elementwise_dtype(out_dtype)
+        if out is not None:
+            assert out.shape == traces.shape, f"'out' must have shape {traces.shape}"
+        if out is not None and out.dtype == compute_dtype:
+            buffer = out
+        else:
+            buffer = np.empty(traces.shape, dtype=compute_dtype)
+        np.copyto(buffer, traces, casting='unsafe')
+
+        # consecutive affine stages are composed and applied at once
+        affine = None
+        dtype = traces.dtype
+        for stage in stages:
+            stage_affine = stage._get_elementwise_affine(channel_ids)
+            if stage_affine is not None:
+                if affine is None:
+                    affine = stage_affine
+                else:
+                    affine = (stage_affine[0] * affine[0], stage_affine[0] * affine[1] + stage_affine[1])
+            else:
+                buffer = _apply_affine(buffer, affine)
+                affine = None
+                buffer = stage._fused_apply(buffer, channel_ids, start_frame)
+            dtype = stage._get_elementwise_dtype(dtype)
+            if np.dtype(dtype).kind in 'iu':
+                # the stage output is cast to integers (truncated, and wrapped on overflow) before the next stage:
+                # affine stages are not composed across integer outputs
+                buffer = _apply_affine(buffer, affine)
+                affine = None
+                buffer = _cast_in_place(buffer, dtype)
+        buffer = _apply_affine(buffer, affine)
+
+        if out is None:
+            return buffer.astype(out_dtype, copy=False)
+        if buffer is not out:
+            np.copyto(out, buffer, casting='unsafe')
+        return out
+
+    def _get_elementwise_dtype(self, dtype):
+        # dtype of the output of an element-wise stage for an input of the given dtype
+        return dtype
+
+    def _get_elementwise_affine(self, channel_ids):
+        # (scalar, offset) if the element-wise stage is affine, None otherwise
+        return None
+
+
+def _cast_in_place(buffer, dtype):
+    # emulates the cast of a stage output to an integer dtype (truncation and overflow as in astype) and keeps the
+    # compute dtype of the buffer for the next stage
+    if np.dtype(dtype).kind in 'iu':
+        np.copyto(buffer, buffer.astype(dtype), casting='unsafe')
+    return buffer
+
+
+def _apply_affine(buffer, affine):
+    if affine is not None:
+        scalar, offset = affine
+        if np.any(scalar != 1):
+            buffer *= scalar
+        if np.any(offset != 0):
+            buffer += offset
+    return buffer
+
@@ -1,18 +1,25 @@
 from spikeextractors import RecordingExtractor
 from spikeextractors.extraction_tools import check_get_traces_args
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+from .recording_stats import get_recording_stats, get_quantile_sketch
 import numpy as np
 
 
 class BlankSaturationRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'BlankSaturation'
+    _fusable = True
+    _elementwise = True
 
-    def __init__(self, recording, threshold=None, seed=0):
+    def __init__(self, recording, threshold=None, seed=0, full_pass=False, n_jobs=1, joblib_backend='loky'):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
         BasePreprocessorRecordingExtractor.__init__(self, recording)
-        random_data = self._get_random_data_for_scaling(seed=seed).ravel()
-        q = np.quantile(random_data, [0.001, 0.5, 1 - 0.001])
+        if full_pass:
+            sketch = get_quantile_sketch(self._recording, n_jobs=n_jobs, joblib_backend=joblib_backend)
+            q = sketch.get_quantiles([0.001, 0.5, 1 - 0.001])
+        else:
+            stats = get_recording_stats(self._recording, seed=seed)
+            q = stats.get_quantiles([0.001, 0.5, 1 - 0.001])
         if 2 * q[1] - q[0] - q[2] < 2 * np.min([q[1] - q[0], q[2] - q[1]]):
             print('Warning, narrow signal range suggests artefact-free data.')
         self._median = q[1]
@@ -31,27 +38,15 @@ class BlankSaturationRecording(BasePreprocessorRecordingExtractor):
                 self._lower = True
         self.has_unscaled = False
 
-        self._kwargs = {'recording': recording.make_serialized_dict(), 'threshold': threshold, 'seed': seed}
-
-    def _get_random_data_for_scaling(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
+        self._kwargs = {'recording': recording.make_serialized_dict(), 'threshold': threshold, 'seed': seed,
+                        'full_pass': full_pass, 'n_jobs': n_jobs, 'joblib_backend': joblib_backend}
 
     @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True, out=None):
         assert return_scaled, "'blank_saturation' only supports return_scaled=True"
+        return self._get_elementwise_traces(channel_ids, start_frame, end_frame, out=out)
 
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame,
-                                            return_scaled=return_scaled)
-        traces = traces.copy()
+    def _fused_apply(self, traces, channel_ids, start_frame):
         if self._lower:
             traces[traces <= self._threshold] = self._median
         else:
@@ -59,7 +54,7 @@ class BlankSaturationRecording(BasePreprocessorRecordingExtractor):
         return traces
 
 
-def blank_saturation(recording, threshold=None, seed=0):
+def blank_saturation(recording, threshold=None, seed=0, full_pass=False, n_jobs=1, joblib_backend='loky'):
     '''
     Find and remove parts of the signal with extereme values. Some arrays
     may produce these when amplifiers enter saturation, typically for
@@ -81,6 +76,13 @@ def blank_saturation(recording, threshold=None, seed=0):
         If `None`, the threshold will be determined from the 0.1 signal percentile.
     seed: int
         Random seed for reproducibility
+    full_pass: bool
+        If True, the percentiles are estimated on the full recording with a mergeable quantile sketch
+        (relative accuracy 0.1%) instead of on random chunks
+    n_jobs: int
+        Number of jobs used for the full pass
+    joblib_backend: str
+        The backend for joblib
     Returns
     -------
     rescaled_traces: BlankSaturationRecording
@@ -89,5 +91,8 @@ def blank_saturation(recording, threshold=None, seed=0):
     return BlankSaturationRecording(
         recording=recording, 
         threshold=threshold,
-        seed=seed
+        seed=seed,
+        full_pass=full_pass,
+        n_jobs=n_jobs,
+        joblib_backend=joblib_backend
     )
@@ -1,5 +1,6 @@
 from spikeextractors import RecordingExtractor
 from .transform import TransformRecording
+from .recording_stats import get_recording_stats
 import numpy as np
 
 
@@ -21,18 +22,19 @@ class CenterRecording(TransformRecording):
         snip_len = seconds / n_snippets * recording.get_sampling_frequency()
 
         if seconds * recording.get_sampling_frequency() >= recording.get_num_frames():
-            traces = recording.get_traces()
+            frame_ranges = [(0, recording.get_num_frames())]
         else:
             # skip initial and final part
             snip_start = np.linspace(snip_len // 2, recording.get_num_frames()-int(1.5*snip_len), n_snippets)
-            traces_snippets = recording.get_snippets(reference_frames=snip_start, snippet_len=snip_len)
-            traces_snippets = traces_snippets.swapaxes(0, 1)
-            traces = traces_snippets.reshape((traces_snippets.shape[0],
-                                              traces_snippets.shape[1] * traces_snippets.shape[2]))
+            snip_len_before = int((snip_len + 1) / 2)
+            snip_len_after = int(snip_len - snip_len_before)
+            frame_ranges = [(max(0, int(ref) - snip_len_before),
+                             min(recording.get_num_frames(), int(ref) + snip_len_after)) for ref in snip_start]
+        stats = get_recording_stats(recording, frame_ranges=frame_ranges)
         if self._mode == 'mean':
-            self._offset = -np.mean(traces, axis=1)
+            self._offset = -stats.get_mean()
         else:
-            self._offset = -np.median(traces, axis=1)
+            self._offset = -stats.get_median()
         dtype = np.dtype(recording.get_dtype()).name
         if 'uint' in dtype:
             dtype = dtype[1:]
@@ -1,12 +1,15 @@
 from spikeextractors import RecordingExtractor
 from spikeextractors.extraction_tools import check_get_traces_args
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+import numpy as np
 
 
 class ClipRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'Clip'
     installed = True  # check at class level if installed or not
     installation_mesg = ""  # err
+    _fusable = True
+    _elementwise = True
 
     def __init__(self, recording, a_min=None, a_max=None):
         if not isinstance(recording, RecordingExtractor):
@@ -18,17 +21,12 @@ class ClipRecording(BasePreprocessorRecordingExtractor):
         self._kwargs = {'recording': recording.make_serialized_dict(), 'a_min': a_min, 'a_max': a_max}
 
     @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True, out=None):
         assert return_scaled, "'clip' only supports return_scaled=True"
+        return self._get_elementwise_traces(channel_ids, start_frame, end_frame, out=out)
 
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame,
-                                            return_scaled=return_scaled)
-        if self._a_min is not None:
-            traces[traces < self._a_min] = self._a_min
-        if self._a_max is not None:
-            traces[traces > self._a_max] = self._a_max
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        np.clip(traces, self._a_min, self._a_max, out=traces)
         return traces
 
 
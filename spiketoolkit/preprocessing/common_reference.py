@@ -1,5 +1,6 @@
 from spikeextractors import RecordingExtractor
 import numpy as np
+import scipy.sparse as sparse
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
 from spikeextractors.extraction_tools import check_get_traces_args
 
@@ -8,14 +9,20 @@ from ..utils import get_closest_channels
 
 class CommonReferenceRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'CommonReference'
+    _fusable = True
+    _mixes_channels = True
 
     def __init__(self, recording, reference='median', groups=None, ref_channels=None,
-                 local_radius=(30, 55), dtype=None, verbose=False):
+                 local_radius=(30, 55), median_kernel='exact', median_tol=0.5, dtype=None, verbose=False):
 
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
         if reference not in ['median', 'average', 'single', 'local']:
             raise ValueError("'reference' must be either 'median', 'average', 'single' or 'local'")
+        if median_kernel not in _median_kernels:
+            raise ValueError("'median_kernel' must be either 'exact', 'partition', 'trimmed_mean' or 'approximate'")
+        if median_kernel == 'approximate':
+            assert median_tol > 0, "'median_tol' must be positive"
         self._ref = reference
         self._groups = groups
         if self._ref == 'single':
@@ -38,9 +45,18 @@ class CommonReferenceRecording(BasePreprocessorRecordingExtractor):
                 mask = (dist[i, :] > local_radius[0]) & (dist[i, :] <= local_radius[1])
                 self.neighbors[i] = closest_inds[i, mask]
                 assert len(self.neighbors[i]) > 0, "No reference channels are inside the local annulus chosen for reference selection."
+            # (channels x channels) operator averaging the neighbors of each channel
+            rows = np.concatenate([[i] * len(self.neighbors[i]) for i in range(recording.get_num_channels())])
+            cols = np.concatenate([self.neighbors[i] for i in range(recording.get_num_channels())])
+            weights = np.concatenate([[1. / len(self.neighbors[i])] * len(self.neighbors[i])
+                                      for i in range(recording.get_num_channels())])
+            self._local_operator = sparse.csr_matrix((weights, (rows, cols)), shape=(recording.get_num_channels(),
+                                                                                     recording.get_num_channels()))
 
         self._ref_channel = ref_channels
         self._local_radius = local_radius
+        self._median_kernel = median_kernel
+        self._median_tol = median_tol
         if dtype is None:
             self._dtype = recording.get_dtype()
         else:
@@ -48,82 +64,104 @@ class CommonReferenceRecording(BasePreprocessorRecordingExtractor):
         self.verbose = verbose
         BasePreprocessorRecordingExtractor.__init__(self, recording)
         self._kwargs = {'recording': recording.make_serialized_dict(), 'reference': reference, 'groups': groups,
-                        'ref_channels': ref_channels, 'local_radius': local_radius,
-                        'dtype': dtype, 'verbose': verbose}
+                        'ref_channels': ref_channels, 'local_radius': local_radius, 'median_kernel': median_kernel,
+                        'median_tol': median_tol, 'dtype': dtype, 'verbose': verbose}
 
     @check_get_traces_args
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
-
-        selected_groups, selected_channels = self._create_channel_groups(channel_ids)
-        traces = None
-
-        if self._ref == 'median':
+        if self._ref == 'local':
             if self.verbose:
+                print('Local Common average using as reference channels in a ring-shape region with radius: ' + str(self._local_radius))
+            # the requested channels and their neighbors are read at once and the reference is a sparse product
+            recording_channel_ids = self._recording.get_channel_ids()
+            channel_idxs = np.array([recording_channel_ids.index(ch) for ch in channel_ids])
+            operator = self._local_operator[channel_idxs]
+            read_idxs = np.union1d(channel_idxs, operator.indices)
+            traces = self._recording.get_traces(channel_ids=[recording_channel_ids[i] for i in read_idxs],
+                                                start_frame=start_frame, end_frame=end_frame,
+                                                return_scaled=return_scaled)
+            reference = operator[:, read_idxs] @ traces
+            traces = traces[np.searchsorted(read_idxs, channel_idxs)] - reference
+            return traces.astype(self._dtype, copy=False)
+
+        selected_groups, selected_channels, selected_refs = self._create_channel_groups(channel_ids)
+        if self.verbose:
+            if self._ref == 'median':
                 if self._groups is None:
                     print('Common median reference using all channels')
                 else:
                     print('Common median in groups: ', selected_groups)
-
-            traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_channel,
-                                                                    start_frame=start_frame, end_frame=end_frame,
-                                                                    return_scaled=return_scaled)
-                                         - np.median(self._recording.get_traces(channel_ids=split_group,
-                                                                                start_frame=start_frame,
-                                                                                end_frame=end_frame,
-                                                                                return_scaled=return_scaled),
-                                                     axis=0, keepdims=True) for (split_channel, split_group) in
-                                         zip(selected_channels, selected_groups)]))
-        elif self._ref == 'average':
-            if self.verbose:
+            elif self._ref == 'average':
                 if self._groups is None:
                     print('Common average reference using all channels')
                 else:
                     print('Common average in groups: ', selected_groups)
-
-            traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_channel,
-                                                                    start_frame=start_frame,
-                                                                    end_frame=end_frame,
-                                                                    return_scaled=return_scaled)
-                                         - np.mean(self._recording.get_traces(channel_ids=split_group,
-                                                                              start_frame=start_frame,
-                                                                              end_frame=end_frame,
-                                                                              return_scaled=return_scaled),
-                                                   axis=0, keepdims=True) for (split_channel, split_group) in
-                                         zip(selected_channels, selected_groups)]))
-        elif self._ref == 'single':
-            if self.verbose:
+            else:
                 if self._groups is None:
                     print('Reference to channel', self._ref_channel)
                 else:
                     print('Reference', selected_groups, 'to channels', self._ref_channel)
 
-            traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_channel,
-                                                                    start_frame=start_frame, end_frame=end_frame,
-                                                                    return_scaled=return_scaled)
-                                         - self._recording.get_traces(channel_ids=[ref], start_frame=start_frame,
-                                                                      end_frame=end_frame,
-                                                                      return_scaled=return_scaled)
-                                         for (split_channel, ref) in zip(selected_channels, self._ref_channel)]))
+        # each group is read once: the reference is computed on the read traces and subtracted from the requested
+        # channels with a single broadcasted operation
+        traces = []
+        for split_channel, split_group, ref in zip(selected_channels, selected_groups, selected_refs):
+            if self._ref == 'single':
+                read_channels = list(split_channel) + [ref] if ref not in split_channel else list(split_channel)
+            else:
+                read_channels = list(split_group)
+            group_traces = self._recording.get_traces(channel_ids=read_channels, start_frame=start_frame,
+                                                      end_frame=end_frame, return_scaled=return_scaled)
+            reference = self._compute_reference(group_traces, read_channels, ref)
+            if list(split_channel) == read_channels:
+                traces.append(group_traces - reference)
+            else:
+                channel_idxs = np.array([read_channels.index(ch) for ch in split_channel])
+                traces.append(group_traces[channel_idxs] - reference)
 
-        elif self._ref == 'local':
-            if self.verbose:
-                print('Local Common average using as reference channels in a ring-shape region with radius: ' + str(self._local_radius))
-            traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame,
-                                                end_frame=end_frame,
-                                                return_scaled=return_scaled) \
-                     - np.vstack(np.array([np.average(
-                self._recording.get_traces(
-                     channel_ids=self.neighbors[self._recording.get_channel_ids().index(id)],
-                     start_frame=start_frame, end_frame=end_frame, return_scaled=return_scaled), axis=0)
-                for id in channel_ids]))
+        if len(traces) == 1:
+            traces = traces[0]
+        else:
+            traces = np.vstack(traces)
+        return traces.astype(self._dtype, copy=False)
 
-        return np.array(traces).astype(self._dtype)
+    def _compute_reference(self, traces, channel_ids, ref=None):
+        # reference of 'traces' (with rows 'channel_ids') as a (1, num_frames) array
+        if self._ref == 'median':
+            if self._median_kernel == 'approximate':
+                return _median_approximate(traces, self._median_tol)
+            return _median_kernels[self._median_kernel](traces)
+        elif self._ref == 'average':
+            return np.mean(traces, axis=0, keepdims=True)
+        else:
+            idx = channel_ids.index(ref)
+            return traces[idx:idx + 1].copy()
+
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        # 'traces' contains all channels of the parent recording
+        if self._ref == 'local':
+            traces -= (self._local_operator @ traces).astype(traces.dtype, copy=False)
+            return traces
+        selected_groups, _, selected_refs = self._create_channel_groups(channel_ids)
+        for group, ref in zip(selected_groups, selected_refs):
+            if len(group) == len(channel_ids):
+                traces -= self._compute_reference(traces, channel_ids, ref)
+            else:
+                group_idxs = np.array([channel_ids.index(ch) for ch in group])
+                if self._ref == 'single':
+                    # the reference channel is not necessarily in the group
+                    reference = self._compute_reference(traces, channel_ids, ref)
+                else:
+                    reference = self._compute_reference(traces[group_idxs], list(group))
+                traces[group_idxs] -= reference
+        return traces
 
     def _create_channel_groups(self, channel_ids):
         selected_groups = []
         selected_channels = []
+        selected_refs = []
         if self._groups:
-            for g in self._groups:
+            for i, g in enumerate(self._groups):
                 new_chans = []
                 for chan in g:
                     if chan in self._recording.get_channel_ids():
@@ -132,14 +170,71 @@ class CommonReferenceRecording(BasePreprocessorRecordingExtractor):
                 if len(selected_channel_for_group) > 0:
                     selected_groups.append(new_chans)
                     selected_channels.append(selected_channel_for_group)
+                    selected_refs.append(self._ref_channel[i] if self._ref == 'single' else None)
         else:
             selected_groups = [self._recording.get_channel_ids()]
             selected_channels = [channel_ids]
-        return selected_groups, selected_channels
+            selected_refs = [self._ref_channel[0] if self._ref == 'single' else None]
+        return selected_groups, selected_channels, selected_refs
+
+
+def _median_exact(traces):
+    return np.median(traces, axis=0, keepdims=True)
+
+
+def _median_partition(traces):
+    # exact median of the float32 traces, selecting only the middle element(s)
+    traces = traces.astype('float32', copy=False)
+    n = traces.shape[0]
+    k = n // 2
+    partitioned = np.partition(traces, k, axis=0)
+    if n % 2 == 1:
+        return partitioned[k:k + 1]
+    # the lower middle element is the maximum of the lower partition
+    return (partitioned[k:k + 1] + np.max(partitioned[:k], axis=0, keepdims=True)) / 2
+
+
+def _trimmed_mean(traces, proportion=0.25):
+    # mean of the channels between the 'proportion' and 1 - 'proportion' quantiles
+    traces = traces.astype('float32', copy=False)
+    n = traces.shape[0]
+    k1 = int(proportion * n)
+    k2 = n - k1
+    if k1 == 0 or k2 - k1 < 1:
+        return np.mean(traces, axis=0, keepdims=True)
+    partitioned = np.partition(traces, [k1, k2 - 1], axis=0)
+    return np.mean(partitioned[k1:k2], axis=0, keepdims=True)
+
+
+def _median_approximate(traces, tol):
+    # bisection on the values: at each step, the interval [low, high] contains the (lower) median of each sample
+    traces = traces.astype('float32', copy=False)
+    rank = (traces.shape[0] + 1) // 2
+    low = np.min(traces, axis=0)
+    high = np.max(traces, axis=0)
+    low_is_median = np.count_nonzero(traces <= low, axis=0) >= rank
+    high[low_is_median] = low[low_is_median]
+    # the interval can't shrink below the float32 spacing of the values, so the tolerance is at least the spacing
+    # and the number of steps is bounded by the halvings of the largest interval
+    tol = np.maximum(np.float32(tol), np.spacing(np.maximum(np.abs(low), np.abs(high))))
+    max_iter = int(np.ceil(np.log2(max(float(np.max(high - low)), 1.) / float(np.min(tol))))) + 8
+    for _ in range(max_iter):
+        if not np.any(high - low > 2 * tol):
+            break
+        mid = (low + high) / 2
+        # counting on uint8 is much faster than summing booleans
+        above = np.add.reduce((traces <= mid).view(np.uint8), axis=0, dtype=np.int32) >= rank
+        high = np.where(above, mid, high)
+        low = np.where(above, low, mid)
+    return ((low + high) / 2)[np.newaxis]
+
+
+_median_kernels = {'exact': _median_exact, 'partition': _median_partition, 'trimmed_mean': _trimmed_mean,
+                   'approximate': _median_approximate}
 
 
-def common_reference(recording, reference='median', groups=None, ref_channels=None, local_radius=(30, 55), dtype=None,
-                     verbose=False):
+def common_reference(recording, reference='median', groups=None, ref_channels=None, local_radius=(30, 55),
+                     median_kernel='exact', median_tol=0.5, dtype=None, verbose=False):
     '''
     Re-references the recording extractor traces.
 
@@ -165,6 +260,15 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         int is expected.
     local_radius: tuple(int, int)
         Use in the local CAR implementation as the selecting annulus (exclude radius, include radius)
+    median_kernel: str
+        'exact', 'partition', 'trimmed_mean' or 'approximate'. Kernel used to compute the reference of the CMR.
+        If 'exact' (default), np.median is used.
+        If 'partition', the exact median is selected with np.partition on float32 traces.
+        If 'trimmed_mean', the mean of the channels between the 25% and 75% quantiles is used.
+        If 'approximate', the median is found by bisection on the values, with an error of at most 'median_tol'
+        (with an even number of channels, the error is relative to the interval between the two middle values).
+    median_tol: float
+        Maximum error on the median when median_kernel is 'approximate' (default 0.5, in units of the traces)
     dtype: str
         dtype of the returned traces. If None, dtype is maintained
     verbose: bool
@@ -177,5 +281,5 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
     '''
     return CommonReferenceRecording(
         recording=recording, reference=reference, groups=groups, ref_channels=ref_channels, local_radius=local_radius,
-        dtype=dtype, verbose=verbose
+        median_kernel=median_kernel, median_tol=median_tol, dtype=dtype, verbose=verbose
     )
@@ -1,16 +1,44 @@
 from abc import abstractmethod
+from collections import OrderedDict
+from threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+import uuid
 import numpy as np
+import scipy.signal as ss
+import scipy.fft as sfft
 from .transform import TransformRecording
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+from .profiling import get_profiling_context, run_in_profiling_context
+from ..utils import get_recording_hash
 from spikeextractors.extraction_tools import check_get_traces_args
 
+# kwargs that do not change the filtered traces and are ignored to identify a preprocessing chain
+EXECUTION_KWARGS = ['cache_chunks', 'cache_mb', 'cache_folder', 'fft_workers', 'n_jobs', 'joblib_backend']
+
 
 class FilterRecording(BasePreprocessorRecordingExtractor):
-    def __init__(self, recording, chunk_size=10000, cache_chunks=False, dtype=None):
+    _fusable = True
+
+    def __init__(self, recording, chunk_size=10000, cache_chunks=False, cache_mb=None, cache_folder=None,
+                 compute_dtype='float64', causal=False, dtype=None, copy_times=True):
         self._chunk_size = chunk_size
+        self._compute_dtype = np.dtype(compute_dtype).name
+        if causal:
+            assert hasattr(self, '_sos'), "The causal mode is only available for IIR filters"
+        self._causal = causal
+        self._stream_state = None
+        self._n_threads = None
         self._cache_chunks = cache_chunks
-        if cache_chunks:
-            self._filtered_cache_chunks = FilteredChunkCache()
+        self._cache_folder = cache_folder
+        self._disk_cache_chunks = None
+        if cache_chunks == 'shared':
+            self._filtered_cache_chunks = get_shared_chunk_cache()
+        elif cache_chunks:
+            if cache_mb is None:
+                cache_mb = DEFAULT_CACHE_MB
+            self._filtered_cache_chunks = FilteredChunkCache(max_mb=cache_mb)
         else:
             self._filtered_cache_chunks = None
         self._traces = None
@@ -31,7 +59,7 @@ class FilterRecording(BasePreprocessorRecordingExtractor):
         else:
             self._dtype = dtype
             recording_base = recording
-        BasePreprocessorRecordingExtractor.__init__(self, recording_base)
+        BasePreprocessorRecordingExtractor.__init__(self, recording_base, copy_times=copy_times)
 
     # avoid filtering one sample
     def get_dtype(self, return_scaled=True):
@@ -43,10 +71,22 @@ class FilterRecording(BasePreprocessorRecordingExtractor):
             ich1 = int(start_frame / self._chunk_size)
             ich2 = int((end_frame - 1) / self._chunk_size)
             dt = self.get_dtype()
-            filtered_chunk = np.zeros((len(channel_ids), int(end_frame-start_frame)), dtype=dt)
+            filtered_chunk = np.empty((len(channel_ids), int(end_frame-start_frame)), dtype=dt)
+            n_threads = self.get_n_threads()
+            # causal chunks depend on the state of the previous chunk and nested pools could deadlock
+            if n_threads > 1 and ich2 > ich1 and not self._causal and not getattr(_thread_state, 'in_pool', False):
+                if return_scaled:
+                    self._get_disk_cache()
+                pool = _get_thread_pool(n_threads)
+                context = get_profiling_context()
+                futures = [pool.submit(_run_in_pool, context, self._get_filtered_chunk, ich, channel_ids,
+                                       return_scaled) for ich in range(ich1, ich2 + 1)]
+                filtered_chunks = (future.result() for future in futures)
+            else:
+                filtered_chunks = (self._get_filtered_chunk(ich, channel_ids, return_scaled)
+                                   for ich in range(ich1, ich2 + 1))
             pos = 0
-            for ich in range(ich1, ich2 + 1):
-                filtered_chunk0 = self._get_filtered_chunk(ich, channel_ids, return_scaled)
+            for ich, filtered_chunk0 in zip(range(ich1, ich2 + 1), filtered_chunks):
                 if ich == ich1:
                     start0 = start_frame - ich * self._chunk_size
                 else:
@@ -62,78 +102,350 @@ class FilterRecording(BasePreprocessorRecordingExtractor):
                                                return_scaled=return_scaled)
         return filtered_chunk.astype(self._dtype)
 
+    def set_n_threads(self, n_threads):
+        """
+        Sets the number of threads used to filter the chunks spanned by a get_traces call.
+
+        Parameters
+        ----------
+        n_threads: int or None
+            Number of threads. If None, the global number of threads (see set_filter_threads) is used
+        """
+        self._n_threads = n_threads
+
+    def get_n_threads(self):
+        n_threads = self._n_threads
+        if n_threads is None:
+            n_threads = _global_n_threads
+        return n_threads
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids, return_scaled=True):
+        if self._causal:
+            return self._filter_chunk_causal(start_frame, end_frame, channel_ids, return_scaled)
+        i1 = start_frame - self._padding
+        i2 = end_frame + self._padding
+        padded_chunk = self._read_chunk(i1, i2, channel_ids, return_scaled)
+        filtered_padded_chunk = self._do_filter(padded_chunk)
+        return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
+
     @abstractmethod
-    def filter_chunk(self, *, start_frame, end_frame, channel_ids, return_scaled):
-        raise NotImplementedError('filter_chunk not implemented')
+    def _do_filter(self, chunk):
+        raise NotImplementedError('_do_filter not implemented')
 
-    def _read_chunk(self, i1, i2, channel_ids, return_scaled=True):
-        num_frames = self._recording.get_num_frames()
-        if i1 < 0:
-            i1b = 0
+    def _apply_sos(self, chunk):
+        sos = self._sos.astype(chunk.dtype)
+        if self._causal:
+            # the filter is assumed at rest before the chunk
+            return ss.sosfilt(sos, chunk, axis=1)
         else:
-            i1b = i1
-        if i2 > num_frames:
-            i2b = num_frames
+            return ss.sosfiltfilt(sos, chunk, axis=1)
+
+    def _filter_chunk_causal(self, start_frame, end_frame, channel_ids, return_scaled):
+        # when chunks are accessed in order, the filter state is carried over and no padding is read
+        state_key = (tuple(channel_ids), return_scaled)
+        sos = self._sos.astype(self._compute_dtype)
+        state = self._stream_state
+        if state is not None and state['next_frame'] == start_frame and state['key'] == state_key:
+            i1 = start_frame
+            zi = state['zi']
+            chunk = self._read_chunk(i1, end_frame, channel_ids, return_scaled)
         else:
-            i2b = i2
-        chunk = np.zeros((len(channel_ids), i2 - i1))
-        chunk[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b,
-                                                                 channel_ids=channel_ids, return_scaled=return_scaled)
+            # random access: the state is rebuilt from the preceding samples (only left padding is needed), starting
+            # from the steady state of the first sample so that offsets do not produce a start-up transient
+            i1 = start_frame - self._padding
+            chunk = self._read_chunk(i1, end_frame, channel_ids, return_scaled)
+            zi = (ss.sosfilt_zi(sos)[:, np.newaxis, :] * chunk[:, 0][np.newaxis, :, np.newaxis]).astype(
+                self._compute_dtype)
+        filtered_chunk, zf = ss.sosfilt(sos, chunk, axis=1, zi=zi)
+        self._stream_state = {'next_frame': end_frame, 'key': state_key, 'zi': zf}
+        return filtered_chunk[:, start_frame - i1:]
 
-        return chunk
+    def _fused_padding(self):
+        return self._padding
 
-    def _get_filtered_chunk(self, ind, channel_ids, return_scaled):
-        if self._cache_chunks:
-            code = str(ind)
-            chunk0 = self._filtered_cache_chunks.get(code)
-        else:
-            chunk0 = None
+    def _fused_compute_dtype(self):
+        return self._compute_dtype
 
-        if chunk0 is not None:
-            if chunk0.shape[0] == len(channel_ids):
-                return chunk0
-            else:
-                channel_idxs = np.array([self.get_channel_ids().index(ch) for ch in channel_ids])
-                return chunk0[channel_idxs]
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        return self._do_filter(traces)
+
+    def _read_chunk(self, i1, i2, channel_ids, return_scaled=True):
+        # the returned chunk can be the array of the parent recording: filters must not modify it in place
+        num_frames = self._recording.get_num_frames()
+        i1b = max(i1, 0)
+        i2b = min(i2, num_frames)
+        traces = self._recording.get_traces(start_frame=i1b, end_frame=i2b, channel_ids=channel_ids,
+                                            return_scaled=return_scaled)
+        if i1b == i1 and i2b == i2:
+            # interior chunk: no copy if the parent already has the compute dtype
+            return traces.astype(self._compute_dtype, copy=False)
+
+        # zeros are only written in the padding outside of the recording
+        chunk = np.empty((len(channel_ids), i2 - i1), dtype=self._compute_dtype)
+        chunk[:, :i1b - i1] = 0
+        chunk[:, i2b - i1:] = 0
+        chunk[:, i1b - i1:i2b - i1] = traces
+
+        return chunk
 
+    def _get_filtered_chunk(self, ind, channel_ids, return_scaled):
         start0 = ind * self._chunk_size
         end0 = (ind + 1) * self._chunk_size
 
-        if self._cache_chunks:
-            # filter all channels if cache_chunks is used
-            chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=self.get_channel_ids())
-            self._filtered_cache_chunks.add(code, chunk1)
-            channel_idxs = np.array([self.get_channel_ids().index(ch) for ch in channel_ids])
-            chunk1 = chunk1[channel_idxs]
+        disk_cache = self._get_disk_cache() if return_scaled else None
+        if self._filtered_cache_chunks is None and disk_cache is None:
+            return self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=channel_ids,
+                                     return_scaled=return_scaled)
+
+        if self._filtered_cache_chunks is not None:
+            # the recording id makes the code unique in the shared cache
+            code = (self.id, ind, return_scaled)
+            cached_rows = self._filtered_cache_chunks.get(code, channel_ids)
         else:
-            # otherwise, only filter requested channels
-            chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=channel_ids,
-                                       return_scaled=return_scaled)
+            cached_rows = dict()
+        missing_channel_ids = [ch for ch in channel_ids if ch not in cached_rows]
+        if len(missing_channel_ids) > 0:
+            if disk_cache is not None:
+                # shards on disk always contain all channels
+                all_channel_ids = self.get_channel_ids()
+                chunk1 = disk_cache.get(ind)
+                if chunk1 is None:
+                    chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=all_channel_ids,
+                                               return_scaled=return_scaled).astype(self._dtype)
+                    disk_cache.add(ind, chunk1)
+                channel_idxs = np.array([all_channel_ids.index(ch) for ch in missing_channel_ids])
+                chunk1 = np.array(chunk1[channel_idxs])
+            else:
+                # only the channels that are not cached are filtered
+                chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=missing_channel_ids,
+                                           return_scaled=return_scaled).astype(self._dtype)
+            if self._filtered_cache_chunks is not None:
+                self._filtered_cache_chunks.add(code, chunk1, missing_channel_ids)
+            cached_rows.update(zip(missing_channel_ids, chunk1))
+
+        return np.array([cached_rows[ch] for ch in channel_ids])
+
+    def _get_disk_cache(self):
+        if self._cache_folder is None:
+            return None
+        if self._disk_cache_chunks is None:
+            if not self.check_if_dumpable():
+                print("The recording is not dumpable: filtered chunks are not cached on disk")
+                self._cache_folder = None
+                return None
+            # the hash is computed lazily because subclasses set their kwargs after initialization
+            chain_hash = get_recording_hash(self, ignore_kwargs=EXECUTION_KWARGS)
+            self._disk_cache_chunks = DiskChunkCache(Path(self._cache_folder) / chain_hash)
+        return self._disk_cache_chunks
+
+    def get_cache_stats(self):
+        """
+        Returns the statistics of the chunk caches (None if chunks are not cached)
+
+        Returns
+        -------
+        stats: dict
+            Dictionary with 'hits', 'misses', 'evictions', 'size_mb', and 'max_mb' of the memory cache and
+            'disk_hits', 'disk_misses' of the disk cache (if used)
+        """
+        if self._filtered_cache_chunks is None and self._cache_folder is None:
+            return None
+        stats = dict()
+        if self._filtered_cache_chunks is not None:
+            stats.update(self._filtered_cache_chunks.get_stats())
+        if self._disk_cache_chunks is not None:
+            stats.update(self._disk_cache_chunks.get_stats())
+        return stats
+
+
+DEFAULT_CACHE_MB = 800
+_shared_chunk_cache = None
+_global_n_threads = 1
+_thread_pools = dict()
+_thread_pools_lock = Lock()
+_thread_state = local()
+
+
+def set_filter_threads(n_threads):
+    """
+    Sets the number of threads used by default by all the filter recordings to filter the chunks spanned by a
+    get_traces call. NumPy FFTs and scipy IIR filters release the GIL, so that the chunks are filtered
+    concurrently.
+
+    Parameters
+    ----------
+    n_threads: int
+        Number of threads (1 to filter the chunks serially)
+    """
+    global _global_n_threads
+    assert n_threads >= 1, "'n_threads' must be at least 1"
+    _global_n_threads = int(n_threads)
+
+
+def _get_thread_pool(n_threads):
+    with _thread_pools_lock:
+        if n_threads not in _thread_pools:
+            _thread_pools[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+        return _thread_pools[n_threads]
+
+
+def _run_in_pool(profiling_context, func, *args):
+    # filter recordings of the chain called by a pool worker filter their chunks serially
+    _thread_state.in_pool = True
+    return run_in_profiling_context(profiling_context, func, *args)
+
+
+def get_shared_chunk_cache(max_mb=None):
+    """
+    Returns the process-wide chunk cache, shared by all the filter recordings instantiated with
+    cache_chunks='shared'.
+
+    Parameters
+    ----------
+    max_mb: float or None
+        If given, the memory budget (in Mb) of the shared cache is set to 'max_mb'
+
+    Returns
+    -------
+    cache: FilteredChunkCache
+        The shared chunk cache
+    """
+    global _shared_chunk_cache
+    if _shared_chunk_cache is None:
+        _shared_chunk_cache = FilteredChunkCache(max_mb=DEFAULT_CACHE_MB)
+    if max_mb is not None:
+        _shared_chunk_cache.set_max_mb(max_mb)
+    return _shared_chunk_cache
 
-        return chunk1
-            
 
 class FilteredChunkCache:
-    def __init__(self):
-        self._chunks_by_code = dict()
-        self._codes = []
-        self._total_size = 0
-        self._max_size = 1024 * 1024 * 100
-
-    def add(self, code, chunk):
-        self._chunks_by_code[code] = chunk
-        self._codes.append(code)
-        self._total_size = self._total_size + chunk.size
-        if self._total_size > self._max_size:
-            ii = 0
-            while (ii < len(self._codes)) and (self._total_size > self._max_size / 2):
-                self._total_size = self._total_size - self._chunks_by_code[self._codes[ii]].size
-                del self._chunks_by_code[self._codes[ii]]
-                ii = ii + 1
-            self._codes = self._codes[ii:]
-
-    def get(self, code):
-        if code in self._chunks_by_code:
-            return self._chunks_by_code[code]
+    """
+    Least-recently-used cache of filtered chunks with a memory budget. Each chunk is stored channel by channel,
+    so that a subset of channels can be cached without filtering all channels.
+    """
+    def __init__(self, max_mb=DEFAULT_CACHE_MB):
+        self._chunks_by_code = OrderedDict()
+        self._total_bytes = 0
+        self._max_bytes = int(max_mb * 1e6)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, code, chunk, channel_ids):
+        with self._lock:
+            rows = self._chunks_by_code.setdefault(code, dict())
+            for ch, row in zip(channel_ids, chunk):
+                if ch in rows:
+                    self._total_bytes -= rows[ch].nbytes
+                rows[ch] = row
+                self._total_bytes += row.nbytes
+            self._chunks_by_code.move_to_end(code)
+            self._evict()
+
+    def get(self, code, channel_ids):
+        # returns a dictionary with the cached rows of the requested channels
+        with self._lock:
+            rows = self._chunks_by_code.get(code)
+            if rows is None:
+                self.misses += 1
+                return dict()
+            self._chunks_by_code.move_to_end(code)
+            cached_rows = {ch: rows[ch] for ch in channel_ids if ch in rows}
+            if len(cached_rows) == len(channel_ids):
+                self.hits += 1
+            else:
+                self.misses += 1
+            return cached_rows
+
+    def set_max_mb(self, max_mb):
+        with self._lock:
+            self._max_bytes = int(max_mb * 1e6)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._chunks_by_code = OrderedDict()
+            self._total_bytes = 0
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size_mb': self._total_bytes / 1e6, 'max_mb': self._max_bytes / 1e6}
+
+    def _evict(self):
+        while self._total_bytes > self._max_bytes and len(self._chunks_by_code) > 0:
+            _, rows = self._chunks_by_code.popitem(last=False)
+            self._total_bytes -= np.sum([row.nbytes for row in rows.values()])
+            self.evictions += 1
+
+
+def check_sos_stability(sos):
+    _, poles, _ = ss.sos2zpk(sos)
+    if not np.all(np.abs(poles) < 1):
+        raise ValueError('Filter is not stable')
+
+
+def get_sos_padding(sos, max_padding, tol=1e-5):
+    # number of samples after which the l1 norm of the tail of the impulse response is below 'tol' times its l1 norm
+    impulse = np.zeros(int(max_padding))
+    impulse[0] = 1
+    impulse_response = np.abs(ss.sosfilt(sos, impulse))
+    return _get_support(impulse_response, tol)
+
+
+def get_kernel_padding(kernel, tol=1e-5):
+    # 'kernel' contains the positive frequencies of a zero-phase filter: the impulse response is symmetric around
+    # sample 0 and the padding is the half-length after which the l1 norm of its tail is below 'tol' times the l1
+    # norm of the half impulse response. The zeroed DC bin removes the mean of each padded chunk, a constant over the
+    # whole kernel that no padding covers: it is excluded from the impulse response
+    kernel = np.array(kernel)
+    if len(kernel) > 1:
+        kernel[0] = kernel[1]
+    impulse_response = np.abs(sfft.irfft(kernel))
+    return _get_support(impulse_response[:len(impulse_response) // 2], tol)
+
+
+def _get_support(impulse_response, tol):
+    # the samples beyond the support contribute at most tol * sum(|h|) * max(|x|) to each output sample, i.e. a
+    # relative error 'tol' on the edges of each filtering pass of a chunk. The support is capped to the length of
+    # 'impulse_response', in which case the error is larger
+    tail_sums = np.cumsum(impulse_response[::-1])[::-1]
+    if len(tail_sums) == 0 or tail_sums[0] == 0:
+        return 0
+    return int(np.count_nonzero(tail_sums > tol * tail_sums[0]))
+
+
+class DiskChunkCache:
+    """
+    Cache of filtered chunks stored as .npy shards (one per chunk, with all channels) in a folder. Shards are read
+    with memory-mapping and written atomically, so that several processes can share the same folder.
+    """
+    def __init__(self, folder):
+        self._folder = Path(folder)
+        self._folder.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, ind, chunk):
+        shard_file = self._get_shard_file(ind)
+        tmp_file = self._folder / f'tmp_{os.getpid()}_{uuid.uuid4().hex}.npy'
+        np.save(tmp_file, chunk)
+        os.replace(tmp_file, shard_file)
+
+    def get(self, ind):
+        shard_file = self._get_shard_file(ind)
+        if shard_file.is_file():
+            with self._lock:
+                self.hits += 1
+            return np.load(shard_file, mmap_mode='r')
         else:
+            with self._lock:
+                self.misses += 1
             return None
+
+    def get_stats(self):
+        return {'disk_hits': self.hits, 'disk_misses': self.misses}
+
+    def _get_shard_file(self, ind):
+        return self._folder / f'chunk_{ind}.npy'
@@ -0,0 +1,132 @@
+from spikeextractors import RecordingExtractor
+from spikeextractors.extraction_tools import check_get_traces_args
+from .basepreprocessorrecording import BasePreprocessorRecordingExtractor, _cast_in_place
+import numpy as np
+
+
+class FusedRecording(BasePreprocessorRecordingExtractor):
+    preprocessor_name = 'Fuse'
+
+    def __init__(self, recording, chunk_size=30000):
+        if not isinstance(recording, RecordingExtractor):
+            raise ValueError("'recording' must be a RecordingExtractor")
+        self._stages = []
+        source = recording
+        while isinstance(source, BasePreprocessorRecordingExtractor) and source._fusable:
+            # stages with chunk statistics (e.g. the mean removed by whitening) only give the traces of the
+            # non-fused chain on their own chunks: they are fused as output stage only, on their chunk grid
+            if source._chunk_statistics and len(self._stages) > 0:
+                break
+            self._stages.append(source)
+            source = source._recording
+        if len(self._stages) > 0 and self._stages[0]._chunk_statistics:
+            chunk_size = self._stages[0]._chunk_size
+        self._chunk_size = chunk_size
+        # stages are applied from the source to the output
+        self._stages = self._stages[::-1]
+        self._source = source
+        self._paddings = [stage._fused_padding() for stage in self._stages]
+        self._mixes_channels = np.any([stage._mixes_channels for stage in self._stages])
+        # the block is processed in the widest compute dtype of the stages
+        self._compute_dtype = np.result_type('float32', *[stage._fused_compute_dtype() for stage in self._stages])
+        self._dtype = recording.get_dtype()
+        BasePreprocessorRecordingExtractor.__init__(self, recording)
+        self.has_unscaled = False
+        self._kwargs = {'recording': recording.make_serialized_dict(), 'chunk_size': self._chunk_size}
+
+    def get_dtype(self, return_scaled=True):
+        return self._dtype
+
+    def get_fused_stages(self):
+        return [stage.preprocessor_name for stage in self._stages]
+
+    @check_get_traces_args
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
+        # fused recordings have no unscaled traces (return_scaled=False is turned into True by check_get_traces_args)
+        assert return_scaled, "'fuse' only supports return_scaled=True"
+        if len(self._stages) == 0:
+            return self._source.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame,
+                                           return_scaled=return_scaled)
+        if self._chunk_size is None:
+            return self._process_block(channel_ids, start_frame, end_frame).astype(self._dtype)
+
+        # chunks are aligned on a fixed grid so that results do not depend on the requested window
+        traces = np.zeros((len(channel_ids), end_frame - start_frame), dtype=self._dtype)
+        ich1 = int(start_frame / self._chunk_size)
+        ich2 = int((end_frame - 1) / self._chunk_size)
+        pos = 0
+        for ich in range(ich1, ich2 + 1):
+            start0 = ich * self._chunk_size
+            end0 = min((ich + 1) * self._chunk_size, self.get_num_frames())
+            block = self._process_block(channel_ids, start0, end0)
+            i1 = max(start_frame, start0) - start0
+            i2 = min(end_frame, end0) - start0
+            traces[:, pos:pos + i2 - i1] = block[:, i1:i2]
+            pos += i2 - i1
+        return traces
+
+    def _process_block(self, channel_ids, start_frame, end_frame):
+        num_frames = self._source.get_num_frames()
+        if self._mixes_channels:
+            read_channel_ids = list(self._source.get_channel_ids())
+        else:
+            read_channel_ids = list(channel_ids)
+
+        # read raw traces once with the union of the paddings of all stages
+        total_padding = int(np.sum(self._paddings))
+        i1 = start_frame - total_padding
+        i2 = end_frame + total_padding
+        i1b = max(i1, 0)
+        i2b = min(i2, num_frames)
+        block = np.zeros((len(read_channel_ids), i2 - i1), dtype=self._compute_dtype)
+        block[:, i1b - i1:i2b - i1] = self._source.get_traces(channel_ids=read_channel_ids, start_frame=i1b,
+                                                              end_frame=i2b)
+
+        for stage, padding in zip(self._stages, self._paddings):
+            block = stage._fused_apply(block, read_channel_ids, i1)
+            if padding > 0:
+                block = block[:, padding:block.shape[1] - padding]
+                i1 += padding
+            # as in the non-fused chain, integer outputs are truncated (and overflow) before the next stage
+            block = _cast_in_place(block, stage.get_dtype())
+            # as in the non-fused chain, samples outside the recording are zeros for the next stage
+            if i1 < 0:
+                block[:, :-i1] = 0
+            if i1 + block.shape[1] > num_frames:
+                block[:, num_frames - i1:] = 0
+
+        if self._mixes_channels and len(channel_ids) < len(read_channel_ids):
+            channel_idxs = np.array([read_channel_ids.index(ch) for ch in channel_ids])
+            block = block[channel_idxs]
+        return block
+
+
+def fuse(recording, chunk_size=30000):
+    '''
+    Compiles a chain of lazy preprocessors (e.g. bandpass_filter -> common_reference -> whiten) into a single
+    per-chunk plan. Raw traces are read once with the union of the paddings required by all the stages and each
+    stage is then applied on the same block, instead of each filtering stage re-reading its own padded window from
+    its parent. Stages that cannot be fused (e.g. resample, remove_bad_channels) are read as a source with get_traces.
+
+    The block is processed in the widest compute dtype of the stages and the output of stages with an integer dtype
+    is cast to that dtype before the next stage, as in the non-fused chain. Fused recordings always return scaled
+    traces. Filters are applied on the fused chunks instead of their own chunks, so the traces differ from the
+    non-fused chain by the filter edge effects, which their 'padding_tol' bounds relative to the maximum absolute value
+    of the traces (see bandpass_filter). Whitening removes the mean of each of its chunks: it is fused only as the
+    last stage, on its own chunk grid (its chunk size replaces 'chunk_size'), and a whitening before other stages is
+    read as a source.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The preprocessed recording extractor to be fused
+    chunk_size: int or None
+        Size of the chunks (in frames) that are processed at once. If None, the requested window is processed at once.
+        If the last stage is a whitening, its chunk size is used.
+
+    Returns
+    -------
+    fused_recording: FusedRecording
+        The fused recording extractor object
+    '''
+    return FusedRecording(recording=recording, chunk_size=chunk_size)
@@ -6,6 +6,8 @@ from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
 
 class MaskRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'Mask'
+    _fusable = True
+    _elementwise = True
 
     def __init__(self, recording, bool_mask):
         if not isinstance(recording, RecordingExtractor):
@@ -19,14 +21,16 @@ class MaskRecording(BasePreprocessorRecordingExtractor):
         self._kwargs = {'recording': recording.make_serialized_dict(), 'bool_mask': bool_mask}
 
     @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame,
-                                            return_scaled=return_scaled)
-
-        traces = traces.copy()  # takes care of memmap objects
-        traces[:, ~self._mask[start_frame:end_frame]] = 0.0
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True, out=None):
+        return self._get_elementwise_traces(channel_ids, start_frame, end_frame, return_scaled=return_scaled, out=out)
+
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        # the block can exceed the recording boundaries when it is padded
+        i1 = max(start_frame, 0)
+        i2 = min(start_frame + traces.shape[1], self.get_num_frames())
+        if i2 > i1:
+            inside = traces[:, i1 - start_frame:i2 - start_frame]
+            inside[:, ~np.asarray(self._mask[i1:i2])] = 0.0
         return traces
 
 
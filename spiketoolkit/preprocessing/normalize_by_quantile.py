@@ -1,47 +1,53 @@
 from spikeextractors import RecordingExtractor
 import numpy as np
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+from .recording_stats import get_recording_stats, get_quantile_sketch
 from spikeextractors.extraction_tools import check_get_traces_args
 
 
 class NormalizeByQuantileRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'NormalizeByQuantile'
+    _fusable = True
+    _elementwise = True
 
-    def __init__(self, recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0):
+    def __init__(self, recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0, full_pass=False, n_jobs=1,
+                 joblib_backend='loky'):
         BasePreprocessorRecordingExtractor.__init__(self, recording)
 
-        random_data = self._get_random_data_for_scaling(seed=seed).ravel()
-        loc_q1, pre_median, loc_q2 = np.quantile(random_data, q=[q1, 0.5, q2])
+        if full_pass:
+            sketch = get_quantile_sketch(self._recording, n_jobs=n_jobs, joblib_backend=joblib_backend)
+            loc_q1, pre_median, loc_q2 = sketch.get_quantiles(q=[q1, 0.5, q2])
+        else:
+            stats = get_recording_stats(self._recording, seed=seed)
+            loc_q1, pre_median, loc_q2 = stats.get_quantiles(q=[q1, 0.5, q2])
         pre_scale = abs(loc_q2 - loc_q1)
 
         self._scalar = scale / pre_scale
         self._offset = median - pre_median * self._scalar
         self.has_unscaled = False
         self._kwargs = {'recording': recording.make_serialized_dict(), 'scale': scale, 'median': median,
-                        'q1': q1, 'q2': q2, 'seed': seed}
-
-    def _get_random_data_for_scaling(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in np.sort(random_ints):
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
+                        'q1': q1, 'q2': q2, 'seed': seed, 'full_pass': full_pass, 'n_jobs': n_jobs,
+                        'joblib_backend': joblib_backend}
 
     @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True, out=None):
         assert return_scaled, "'normalize_by_quantile' only supports return_scaled=True"
+        return self._get_elementwise_traces(channel_ids, start_frame, end_frame, out=out)
+
+    def _get_elementwise_dtype(self, dtype):
+        return np.result_type(dtype, 1.)
+
+    def _get_elementwise_affine(self, channel_ids):
+        return self._scalar, self._offset
 
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame,
-                                            return_scaled=return_scaled)
-        return traces * self._scalar + self._offset
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        traces *= self._scalar
+        traces += self._offset
+        return traces
 
 
-def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0):
+def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0, full_pass=False, n_jobs=1,
+                          joblib_backend='loky'):
     '''
     Rescale the traces from the given recording extractor with a scalar
     and offset. First, the median and quantiles of the distribution are estimated.
@@ -63,6 +69,13 @@ def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, se
         Upper quantile used for measuring the 
     seed: int
         Random seed for reproducibility
+    full_pass: bool
+        If True, the quantiles are estimated on the full recording with a mergeable quantile sketch
+        (relative accuracy 0.1%) instead of on random chunks
+    n_jobs: int
+        Number of jobs used for the full pass
+    joblib_backend: str
+        The backend for joblib
     Returns
     -------
     rescaled_traces: NormalizeByQuantileRecording
@@ -74,5 +87,8 @@ def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, se
         median=median, 
         q1=q1, 
         q2=q2,
-        seed=seed
+        seed=seed,
+        full_pass=full_pass,
+        n_jobs=n_jobs,
+        joblib_backend=joblib_backend
     )
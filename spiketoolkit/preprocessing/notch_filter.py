@@ -1,4 +1,4 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, check_sos_stability, get_sos_padding
 import spikeextractors as se
 import numpy as np
 import scipy.signal as ss
@@ -7,33 +7,40 @@ import scipy.signal as ss
 class NotchFilterRecording(FilterRecording):
     preprocessor_name = 'NotchFilter'
 
-    def __init__(self, recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False):
+    def __init__(self, recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False, cache_mb=None,
+                 cache_folder=None, compute_dtype='float64', causal=False, padding_tol=1e-5):
         self._freq = freq
         self._q = q
+        self._padding_tol = padding_tol
         fn = 0.5 * float(recording.get_sampling_frequency())
-        self._b, self._a = ss.iirnotch(self._freq / fn, self._q)
-
-        if not np.all(np.abs(np.roots(self._a)) < 1):
-            raise ValueError('Filter is not stable')
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
+        # multiple frequencies (e.g. line noise harmonics) are cascaded in a single sos filter
+        freqs = np.atleast_1d(freq).astype('float64')
+        qs = np.broadcast_to(np.atleast_1d(q), freqs.shape)
+        assert np.all((freqs > 0) & (freqs < fn)), "'freq' must be between 0 and the Nyquist frequency"
+        sos_list = []
+        for f, qf in zip(freqs, qs):
+            b, a = ss.iirnotch(f / fn, qf)
+            sos_list.append(ss.tf2sos(b, a))
+        self._sos = np.vstack(sos_list)
+        check_sos_stability(self._sos)
+        # the padding covers the impulse response of the filter (at most 1 s)
+        self._padding = get_sos_padding(self._sos, int(recording.get_sampling_frequency()), tol=padding_tol)
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 cache_mb=cache_mb, cache_folder=cache_folder, compute_dtype=compute_dtype,
+                                 causal=causal)
         self._kwargs = {'recording': recording.make_serialized_dict(), 'freq': freq,
-                        'q': q, 'chunk_size': chunk_size, 'cache_chunks': cache_chunks}
-
-    def filter_chunk(self, start_frame, end_frame, channel_ids, return_scaled):
-        padding = 3000
-        i1 = start_frame - padding
-        i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2, channel_ids, return_scaled)
-        filtered_padded_chunk = self._do_filter(padded_chunk)
-        return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
+                        'q': q, 'chunk_size': chunk_size, 'cache_chunks': cache_chunks, 'cache_mb': cache_mb,
+                        'cache_folder': cache_folder, 'compute_dtype': compute_dtype, 'causal': causal,
+                        'padding_tol': padding_tol}
 
     def _do_filter(self, chunk):
-        chunk_filtered = ss.filtfilt(self._b, self._a, chunk, axis=1)
+        chunk_filtered = self._apply_sos(chunk)
 
         return chunk_filtered
 
 
-def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False):
+def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False, cache_mb=None,
+                 cache_folder=None, compute_dtype='float64', causal=False, padding_tol=1e-5):
     '''
     Performs a notch filter on the recording extractor traces using scipy iirnotch function.
 
@@ -41,14 +48,32 @@ def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_chunks=Fals
     ----------
     recording: RecordingExtractor
         The recording extractor to be notch-filtered.
-    freq: int or float
-        The target frequency of the notch filter.
-    q: int
-        The quality factor of the notch filter.
+    freq: int, float, or list
+        The target frequency of the notch filter. If a list, all the frequencies (e.g. line noise and its harmonics)
+        are removed in a single pass with a cascade of notch filters
+    q: int or list
+        The quality factor of the notch filter (one per frequency if a list).
     chunk_size: int
         The chunk size to be used for the filtering.
-    cache_chunks: bool (default False).
-        If True then each chunk is cached in memory (in a dict)
+    cache_chunks: bool or 'shared' (default False).
+        If True then each chunk is cached in memory in a least-recently-used cache of 'cache_mb' Mb.
+        If 'shared', chunks are cached in the process-wide cache shared by all filter recordings
+    cache_mb: float or None
+        Memory budget in Mb of the chunk cache when cache_chunks is True (default 800 Mb)
+    cache_folder: str, Path, or None
+        If given, filtered chunks are also cached on disk in a sub-folder of 'cache_folder' identified by the hash of
+        the preprocessing chain, so that they are reused by other processes (the recording must be dumpable)
+    compute_dtype: dtype
+        The dtype used for the filtering computations: 'float64' (default) or 'float32', which halves the memory
+        traffic per chunk
+    causal: bool
+        If True, the notch filter is applied forward only (sosfilt) instead of forward-backward (sosfiltfilt). When
+        chunks are read in order, the filter state is carried between consecutive chunks so that no padding is read
+    padding_tol: float
+        The padding read on each side of a chunk is the length after which the tail of the filter impulse response
+        has a sum of absolute values below 'padding_tol' times the sum of absolute values of the impulse response
+        (capped to 1 s). Each filter pass on a chunk then differs from the unchunked filtering by at most
+        'padding_tol' times that sum times the maximum absolute value of the traces (default 1e-5)
     Returns
     -------
     filter_recording: NotchFilterRecording
@@ -61,5 +86,10 @@ def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_chunks=Fals
         q=q,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
+        cache_mb=cache_mb,
+        cache_folder=cache_folder,
+        compute_dtype=compute_dtype,
+        causal=causal,
+        padding_tol=padding_tol
     )
     return notch_recording
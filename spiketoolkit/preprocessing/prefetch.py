@@ -0,0 +1,106 @@
+from spikeextractors.extraction_tools import check_get_traces_args
+from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+from .profiling import get_profiling_context, run_in_profiling_context
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class PrefetchRecording(BasePreprocessorRecordingExtractor):
+    preprocessor_name = 'Prefetch'
+
+    def __init__(self, recording, n_prefetch=2):
+        assert n_prefetch >= 1, "'n_prefetch' must be at least 1"
+        BasePreprocessorRecordingExtractor.__init__(self, recording)
+        self._n_prefetch = n_prefetch
+        # the executor is created at the first read, so that the extractor can be pickled before
+        self._executor = None
+        self._futures = dict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._kwargs = {'recording': recording.make_serialized_dict(), 'n_prefetch': n_prefetch}
+
+    @check_get_traces_args
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
+        channel_ids = list(channel_ids)
+        key = (start_frame, end_frame, tuple(channel_ids), return_scaled)
+        context = get_profiling_context()
+        with self._lock:
+            future = self._futures.pop(key, None)
+            if future is None:
+                # the access is not sequential: the pending reads are dropped
+                self.misses += 1
+                for pending in self._futures.values():
+                    pending.cancel()
+                self._futures = dict()
+                # all the reads go through the worker, so that the parent is always read in order
+                future = self._get_executor().submit(run_in_profiling_context, context, self._read, channel_ids,
+                                                     start_frame, end_frame, return_scaled)
+            else:
+                self.hits += 1
+            # the next blocks of the same size are read in the background
+            block_size = end_frame - start_frame
+            for i in range(1, self._n_prefetch + 1):
+                start_next = start_frame + i * block_size
+                end_next = min(start_next + block_size, self.get_num_frames())
+                if start_next >= self.get_num_frames():
+                    break
+                key_next = (start_next, end_next, tuple(channel_ids), return_scaled)
+                if key_next not in self._futures:
+                    self._futures[key_next] = self._get_executor().submit(run_in_profiling_context, context,
+                                                                          self._read, channel_ids, start_next,
+                                                                          end_next, return_scaled)
+        return future.result()
+
+    def get_prefetch_stats(self):
+        """
+        Returns the number of reads served by the prefetcher ('hits') and read on demand ('misses')
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _read(self, channel_ids, start_frame, end_frame, return_scaled):
+        return self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame,
+                                          return_scaled=return_scaled)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # a single worker reads the blocks in order (e.g. for causal filters)
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_futures'] = dict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+
+def prefetch(recording, n_prefetch=2):
+    '''
+    Reads ahead the traces of the recording on a background thread. When the traces are read in consecutive
+    blocks of the same size (e.g. chunk by chunk), the next 'n_prefetch' blocks are read (and preprocessed)
+    while the current block is processed, overlapping disk I/O and filtering with computation.
+    Non-sequential reads are served directly.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to be read ahead
+    n_prefetch: int
+        Number of blocks read ahead
+
+    Returns
+    -------
+    prefetched_recording: PrefetchRecording
+        The prefetched recording extractor object
+
+    '''
+    return PrefetchRecording(
+        recording=recording,
+        n_prefetch=n_prefetch
+    )
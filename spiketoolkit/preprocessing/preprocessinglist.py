@@ -13,6 +13,8 @@ from .clip import clip, ClipRecording
 from .blank_saturation import blank_saturation, BlankSaturationRecording
 from .center import center, CenterRecording
 from .mask import mask, MaskRecording
+from .fuse import fuse, FusedRecording
+from .prefetch import prefetch, PrefetchRecording
 
 preprocessers_full_list = [
     HighpassFilterRecording,
@@ -29,7 +31,9 @@ preprocessers_full_list = [
     ClipRecording,
     BlankSaturationRecording,
     CenterRecording,
-    MaskRecording
+    MaskRecording,
+    FusedRecording,
+    PrefetchRecording
 ]
 
 installed_preprocessers_list = [pp for pp in preprocessers_full_list if pp.installed]
@@ -0,0 +1,248 @@
+from contextlib import contextmanager
+from threading import RLock, local
+import functools
+import weakref
+import atexit
+import time
+import os
+
+# profiler recording the get_traces calls of the preprocessors (None if profiling is disabled)
+_active_profiler = None
+
+
+class PreprocessingProfiler:
+    """
+    Records, for each preprocessor instance, the number of get_traces calls, the number of samples x channels
+    returned, the wall time exclusive of the parent recordings, the bytes of the returned traces and the cache hits
+    (for filter recordings with chunk caches and prefetched recordings).
+
+    The calls made by the threads of filter recordings (see set_filter_threads) and prefetched recordings are
+    counted as calls of the parent call. The time of these threads is summed, so that when they run concurrently
+    the exclusive time of the recording that started them is a lower bound (it is clamped at 0).
+    """
+    def __init__(self):
+        # statistics of the living recordings by id (removed when the recording is garbage collected, so that a new
+        # recording with the same id starts from empty statistics) and of the collected recordings by name
+        self._stats = dict()
+        self._names = dict()
+        self._collected_stats = dict()
+        # reentrant: a recording can be collected (and its statistics moved) while the lock is held
+        self._lock = RLock()
+        self._local = local()
+
+    def get_stats(self, recording=None):
+        """
+        Returns the profiling statistics
+
+        Parameters
+        ----------
+        recording: RecordingExtractor or None
+            If given, the statistics of this recording are returned, otherwise the statistics of all the
+            profiled recordings are returned by preprocessor name
+
+        Returns
+        -------
+        stats: dict
+            Dictionary with 'calls', 'samples', 'time', 'bytes', and 'cache_hits'
+        """
+        with self._lock:
+            if recording is not None:
+                return dict(self._stats.get(id(recording), _empty_stats()))
+            stats_by_name = {name: dict(stats) for name, stats in self._collected_stats.items()}
+            for rec_id, stats in self._stats.items():
+                _add_stats(stats_by_name.setdefault(self._names[rec_id], _empty_stats()), stats)
+            return stats_by_name
+
+    def get_report(self, recording):
+        """
+        Returns a report of the profiling statistics of the chain that produces the recording, as a tree with one
+        line per extractor (the recording first and its parents below)
+
+        Parameters
+        ----------
+        recording: RecordingExtractor
+            The last recording of the chain
+
+        Returns
+        -------
+        report: str
+            The tree-shaped report
+        """
+        lines = []
+        self._add_report_lines(recording, lines, depth=0)
+        return '\n'.join(lines)
+
+    def print_report(self, recording):
+        print(self.get_report(recording))
+
+    def reset(self):
+        with self._lock:
+            self._stats = dict()
+            self._names = dict()
+            self._collected_stats = dict()
+
+    def _add_report_lines(self, recording, lines, depth):
+        name = getattr(recording, 'preprocessor_name', type(recording).__name__)
+        stats = self.get_stats(recording)
+        prefix = '  ' * (depth - 1) + '└─ ' if depth > 0 else ''
+        if stats['calls'] > 0:
+            lines.append(f"{prefix}{name}: {stats['calls']} calls, {stats['samples']:.3g} samples x channels, "
+                         f"{stats['time']:.3f} s, {stats['bytes'] / 1e6:.1f} MB, {stats['cache_hits']} cache hits")
+        else:
+            lines.append(f"{prefix}{name}")
+        for parent in _get_parents(recording):
+            self._add_report_lines(parent, lines, depth + 1)
+
+    def _call(self, get_traces, recording, args, kwargs):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        stack = self._local.stack
+        # calls of the same recording (e.g. to the get_traces of a parent class) are counted once
+        if len(stack) > 0 and stack[-1][0] is recording:
+            return get_traces(recording, *args, **kwargs)
+
+        hits_start = _get_cache_hits(recording)
+        entry = [recording, 0.]
+        stack.append(entry)
+        t_start = time.perf_counter()
+        try:
+            traces = get_traces(recording, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t_start
+            stack.pop()
+            if len(stack) > 0:
+                # the parent entry can be shared with worker threads
+                with self._lock:
+                    stack[-1][1] += elapsed
+
+        with self._lock:
+            rec_id = id(recording)
+            if rec_id not in self._stats:
+                self._stats[rec_id] = _empty_stats()
+                self._names[rec_id] = getattr(recording, 'preprocessor_name', type(recording).__name__)
+                weakref.finalize(recording, self._collect, rec_id)
+            stats = self._stats[rec_id]
+            stats['calls'] += 1
+            stats['samples'] += traces.size
+            stats['time'] += max(elapsed - entry[1], 0.)
+            stats['bytes'] += traces.nbytes
+            stats['cache_hits'] += _get_cache_hits(recording) - hits_start
+        return traces
+
+    def _collect(self, rec_id):
+        with self._lock:
+            if rec_id in self._stats:
+                stats = self._stats.pop(rec_id)
+                _add_stats(self._collected_stats.setdefault(self._names.pop(rec_id), _empty_stats()), stats)
+
+    def _get_context(self):
+        stack = getattr(self._local, 'stack', [])
+        return stack[-1] if len(stack) > 0 else None
+
+    def _run_in_context(self, entry, func, args):
+        previous_stack = getattr(self._local, 'stack', [])
+        self._local.stack = [entry] if entry is not None else []
+        try:
+            return func(*args)
+        finally:
+            self._local.stack = previous_stack
+
+
+@contextmanager
+def profile_preprocessing():
+    '''
+    Context manager that profiles the get_traces calls of all the preprocessors.
+    Profiling can also be enabled for a whole session by setting the SPIKETOOLKIT_PROFILE environment variable:
+    in that case the statistics by preprocessor are printed at exit.
+
+    Examples
+    --------
+    >>> with profile_preprocessing() as profiler:
+    ...     recording_cmr.get_traces()
+    >>> profiler.print_report(recording_cmr)
+
+    Returns
+    -------
+    profiler: PreprocessingProfiler
+        The profiler recording the statistics
+    '''
+    global _active_profiler
+    previous_profiler = _active_profiler
+    profiler = PreprocessingProfiler()
+    _active_profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _active_profiler = previous_profiler
+
+
+def get_active_profiler():
+    return _active_profiler
+
+
+def get_profiling_context():
+    # context of the current get_traces call, to be passed to the threads that it starts
+    profiler = _active_profiler
+    if profiler is None:
+        return None
+    return profiler, profiler._get_context()
+
+
+def run_in_profiling_context(context, func, *args):
+    # runs 'func' in a worker thread with the get_traces calls counted as calls of the context
+    if context is None:
+        return func(*args)
+    profiler, entry = context
+    return profiler._run_in_context(entry, func, args)
+
+
+def profiled(get_traces):
+    # wraps the get_traces of the preprocessors, with a single check when profiling is disabled
+    @functools.wraps(get_traces)
+    def wrapper(self, *args, **kwargs):
+        profiler = _active_profiler
+        if profiler is None:
+            return get_traces(self, *args, **kwargs)
+        return profiler._call(get_traces, self, args, kwargs)
+    return wrapper
+
+
+def _empty_stats():
+    return {'calls': 0, 'samples': 0, 'time': 0., 'bytes': 0, 'cache_hits': 0}
+
+
+def _add_stats(total, stats):
+    for key in total:
+        total[key] += stats[key]
+
+
+def _get_cache_hits(recording):
+    if hasattr(recording, 'get_cache_stats'):
+        stats = recording.get_cache_stats()
+        if stats is not None:
+            return stats.get('hits', 0) + stats.get('disk_hits', 0)
+    elif hasattr(recording, 'get_prefetch_stats'):
+        return recording.get_prefetch_stats()['hits']
+    return 0
+
+
+def _get_parents(recording):
+    for attr in ['_recording', '_parent_recording']:
+        parent = getattr(recording, attr, None)
+        if parent is not None:
+            return [parent]
+    return []
+
+
+def _print_session_report():
+    stats_by_name = _active_profiler.get_stats()
+    if len(stats_by_name) > 0:
+        print('Preprocessing profile:')
+        for name, stats in stats_by_name.items():
+            print(f"{name}: {stats['calls']} calls, {stats['samples']:.3g} samples x channels, "
+                  f"{stats['time']:.3f} s, {stats['bytes'] / 1e6:.1f} MB, {stats['cache_hits']} cache hits")
+
+
+if os.environ.get('SPIKETOOLKIT_PROFILE', '') not in ['', '0']:
+    _active_profiler = PreprocessingProfiler()
+    atexit.register(_print_session_report)
@@ -0,0 +1,394 @@
+from .filterrecording import EXECUTION_KWARGS
+from ..utils import get_recording_hash
+from joblib import Parallel, delayed
+from collections import OrderedDict
+import spikeextractors as se
+import numpy as np
+
+# statistics computed in this process, by preprocessing chain and sampled frame ranges. The cached statistics keep
+# their sampled traces, so the cache has a memory budget: samples larger than the budget are not cached
+DEFAULT_STATS_CACHE_MB = 100
+_recording_stats_cache = OrderedDict()
+_max_cached_stats = 8
+_max_cached_bytes = int(DEFAULT_STATS_CACHE_MB * 1e6)
+
+
+class RecordingStats:
+    """Per-channel statistics of a recording estimated on a sample of its traces
+
+    The sample is read once and the statistics are computed lazily and memoized, so that all the
+    consumers of the same sample (e.g. whitening, quantile normalization, noise levels) share both the
+    reads and the computations.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to sample
+    frame_ranges: list
+        List of (start_frame, end_frame) ranges that are sampled, in order
+    n_jobs: int
+        Number of jobs used to read the sample
+    joblib_backend: str
+        The backend for joblib
+    """
+
+    def __init__(self, recording, frame_ranges, n_jobs=1, joblib_backend='loky'):
+        self.frame_ranges = [(int(start), int(end)) for (start, end) in frame_ranges]
+        self.channel_ids = recording.get_channel_ids()
+        self._traces = _read_frame_ranges(recording, self.frame_ranges, n_jobs, joblib_backend)
+        self._stats = dict()
+
+    def get_traces(self):
+        """Returns the sampled traces (num_channels x num_samples)"""
+        return self._traces
+
+    def get_num_samples(self):
+        return self._traces.shape[1]
+
+    def get_nbytes(self):
+        return self._traces.nbytes
+
+    def get_mean(self):
+        return self._memoize('mean', lambda: np.mean(self._traces, axis=1))
+
+    def get_median(self):
+        return self._memoize('median', lambda: np.median(self._traces, axis=1))
+
+    def get_std(self):
+        return self._memoize('std', lambda: np.std(self._traces, axis=1))
+
+    def get_mad(self, centered=True):
+        """Returns the median absolute deviation per channel, scaled to be a noise level estimate (/ 0.6745)
+
+        If 'centered' is False, the absolute values are not centered on the median of the channel.
+        """
+        if centered:
+            return self._memoize('mad', lambda: np.median(np.abs(self._traces - self.get_median()[:, np.newaxis])
+                                                          / 0.6745, axis=1))
+        else:
+            return self._memoize('mad_uncentered', lambda: np.median(np.abs(self._traces) / 0.6745, axis=1))
+
+    def get_noise_levels(self, mode='mad', centered=True):
+        """Returns the noise level per channel: 'mad' (default) or 'std'"""
+        if mode == 'mad':
+            return self.get_mad(centered=centered)
+        elif mode == 'std':
+            return self.get_std()
+        else:
+            raise ValueError("'mode' can be 'std' or 'mad'")
+
+    def get_covariance(self):
+        """Returns the covariance matrix of the channels (normalized by the number of samples)"""
+        def _covariance():
+            data = self._traces - np.mean(self._traces, axis=1, keepdims=True)
+            return data @ np.transpose(data) / data.shape[1]
+        return self._memoize('covariance', _covariance)
+
+    def get_quantiles(self, q, pooled=True):
+        """Returns the quantiles 'q' of the sample
+
+        If 'pooled' is True, the quantiles are computed on the samples of all channels together, otherwise
+        they are computed per channel (shape: len(q) x num_channels).
+        """
+        key = ('quantiles', tuple(np.atleast_1d(q)), pooled)
+        if pooled:
+            return self._memoize(key, lambda: np.quantile(self._traces.ravel(), q))
+        else:
+            return self._memoize(key, lambda: np.quantile(self._traces, q, axis=1))
+
+    def _memoize(self, key, compute):
+        if key not in self._stats:
+            self._stats[key] = compute()
+        return self._stats[key]
+
+
+class QuantileSketch:
+    """Mergeable sketch of a distribution with relative accuracy guarantees on its quantiles
+
+    Values are counted in logarithmically spaced buckets (separately for positive and negative values),
+    so that any quantile is returned with a relative error below 'relative_accuracy'. As with np.quantile,
+    quantiles are interpolated linearly between the values of the adjacent ranks. Values with an
+    absolute value below 'min_value' are counted as zeros. Sketches built with the same parameters
+    on different data (e.g. different chunks or workers) can be merged.
+
+    Parameters
+    ----------
+    relative_accuracy: float
+        Relative accuracy of the returned quantiles
+    min_value: float
+        Smallest absolute value that is distinguished from zero
+    """
+
+    def __init__(self, relative_accuracy=1e-3, min_value=1e-9):
+        assert 0 < relative_accuracy < 1, "'relative_accuracy' must be in (0, 1)"
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log2_gamma = np.log2(self._gamma)
+        # each store is (key of the first bucket, counts of the buckets)
+        self._positive = (0, np.zeros(0, dtype='int64'))
+        self._negative = (0, np.zeros(0, dtype='int64'))
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, values):
+        values = np.ravel(values)
+        if len(values) == 0:
+            return
+        dtype = 'float32' if values.dtype.itemsize <= 4 else 'float64'
+        # values below 'min_value' fall in the bucket of 'min_value', which is used as zero bucket
+        abs_values = np.maximum(np.abs(values, dtype=dtype), self.min_value)
+        keys = np.ceil(np.log2(abs_values) * np.array(1 / self._log2_gamma, dtype=dtype)).astype('int32')
+        zero_key = self._get_key(self.min_value)
+        keys -= zero_key
+        span = int(keys.max()) + 1
+        # single count of the positive and (shifted) negative buckets
+        keys += span * (values < 0)
+        counts = np.bincount(keys, minlength=2 * span)
+        self._positive = _merge_stores(self._positive, (zero_key + 1, counts[1:span]))
+        self._negative = _merge_stores(self._negative, (zero_key + 1, counts[span + 1:]))
+        self.zero_count += int(counts[0] + counts[span])
+        self.count += len(values)
+
+    def merge(self, other):
+        assert other.relative_accuracy == self.relative_accuracy and other.min_value == self.min_value, \
+            "Only sketches with the same parameters can be merged"
+        self._positive = _merge_stores(self._positive, other._positive)
+        self._negative = _merge_stores(self._negative, other._negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def get_quantiles(self, q):
+        """Returns the quantiles 'q' of the values added to the sketch"""
+        assert self.count > 0, "The sketch is empty"
+        neg_offset, neg_counts = self._negative
+        pos_offset, pos_counts = self._positive
+        # buckets in increasing order of value: negative buckets from the largest key, zeros, positive buckets
+        values = np.concatenate([-self._get_bucket_values(neg_offset + np.arange(len(neg_counts)))[::-1], [0.],
+                                 self._get_bucket_values(pos_offset + np.arange(len(pos_counts)))])
+        cum_counts = np.cumsum(np.concatenate([neg_counts[::-1], [self.zero_count], pos_counts]))
+        ranks = np.asarray(q, dtype='float64') * (self.count - 1)
+        # linear interpolation between the values of the adjacent ranks, as the default method of np.quantile
+        ranks_low = np.floor(ranks)
+        ranks_high = np.minimum(ranks_low + 1, self.count - 1)
+        values_low = values[np.searchsorted(cum_counts, ranks_low, side='right')]
+        values_high = values[np.searchsorted(cum_counts, ranks_high, side='right')]
+        return values_low + (ranks - ranks_low) * (values_high - values_low)
+
+    def _get_key(self, value):
+        return int(np.ceil(np.log2(value) / self._log2_gamma))
+
+    def get_nbytes(self):
+        return self._positive[1].nbytes + self._negative[1].nbytes
+
+    def _get_bucket_values(self, keys):
+        # value with the smallest relative error over the bucket (gamma^(key-1), gamma^key]
+        return 2 * self._gamma ** keys / (self._gamma + 1)
+
+
+def _merge_stores(store1, store2):
+    (offset1, counts1), (offset2, counts2) = store1, store2
+    if len(counts1) == 0:
+        return store2
+    if len(counts2) == 0:
+        return store1
+    offset = min(offset1, offset2)
+    counts = np.zeros(max(offset1 + len(counts1), offset2 + len(counts2)) - offset, dtype='int64')
+    counts[offset1 - offset:offset1 - offset + len(counts1)] += counts1
+    counts[offset2 - offset:offset2 - offset + len(counts2)] += counts2
+    return (offset, counts)
+
+
+def get_recording_stats(recording, num_chunks=50, chunk_size=500, seed=0, frame_ranges=None, n_jobs=1,
+                        joblib_backend='loky', use_cache=True):
+    '''
+    Returns the statistics of a recording estimated on a sample of its traces.
+
+    By default, 'num_chunks' chunks of 'chunk_size' frames are sampled at random positions. The statistics
+    of dumpable recordings are cached by preprocessing chain and sampled frames, so that preprocessors and
+    metrics that use the same sample of the same recording read it only once. The cache keeps the sampled
+    traces within a memory budget (see set_recording_stats_cache_mb() and clear_recording_stats_cache()).
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to sample
+    num_chunks: int
+        Number of random chunks
+    chunk_size: int
+        Size of each random chunk in frames. If larger than the recording, the full recording is used
+    seed: int
+        Random seed for reproducibility
+    frame_ranges: list or None
+        List of (start_frame, end_frame) ranges to sample instead of the random chunks
+    n_jobs: int
+        Number of jobs used to read the sample
+    joblib_backend: str
+        The backend for joblib
+    use_cache: bool
+        If False, the statistics are neither read from nor added to the cache
+
+    Returns
+    -------
+    stats: RecordingStats
+        The statistics of the recording
+    '''
+    if frame_ranges is None:
+        frame_ranges = get_random_frame_ranges(recording.get_num_frames(), num_chunks=num_chunks,
+                                               chunk_size=chunk_size, seed=seed)
+    frame_ranges = [(int(start), int(end)) for (start, end) in frame_ranges]
+
+    if use_cache and recording.check_if_dumpable():
+        key = (get_recording_hash(recording, ignore_kwargs=EXECUTION_KWARGS), tuple(frame_ranges))
+    else:
+        key = None
+    if key is not None and key in _recording_stats_cache:
+        _recording_stats_cache.move_to_end(key)
+        return _recording_stats_cache[key]
+
+    stats = RecordingStats(recording, frame_ranges, n_jobs=n_jobs, joblib_backend=joblib_backend)
+    if key is not None:
+        _add_to_cache(key, stats)
+    return stats
+
+
+def get_quantile_sketch(recording, relative_accuracy=1e-3, chunk_size=30000, n_jobs=1, joblib_backend='loky'):
+    '''
+    Returns a quantile sketch of all the samples of a recording (pooled across channels).
+
+    The recording is processed in chunks, in parallel if 'n_jobs' > 1, and the sketches of the
+    chunks are merged. The sketches of dumpable recordings are cached by preprocessing chain.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to sketch
+    relative_accuracy: float
+        Relative accuracy of the quantiles returned by the sketch
+    chunk_size: int
+        Size of the chunks in frames
+    n_jobs: int
+        Number of jobs used to process the chunks
+    joblib_backend: str
+        The backend for joblib
+
+    Returns
+    -------
+    sketch: QuantileSketch
+        The merged quantile sketch of the recording
+    '''
+    if recording.check_if_dumpable():
+        key = (get_recording_hash(recording, ignore_kwargs=EXECUTION_KWARGS), 'sketch', relative_accuracy)
+    else:
+        key = None
+    if key is not None and key in _recording_stats_cache:
+        _recording_stats_cache.move_to_end(key)
+        return _recording_stats_cache[key]
+
+    num_frames = recording.get_num_frames()
+    frame_ranges = [(start, min(start + chunk_size, num_frames)) for start in range(0, num_frames, chunk_size)]
+    rec_arg, n_jobs = _get_rec_arg(recording, n_jobs)
+    if n_jobs > 1:
+        frame_ranges_jobs = [fr for fr in np.array_split(np.array(frame_ranges), n_jobs) if len(fr) > 0]
+        sketches = Parallel(n_jobs=n_jobs, backend=joblib_backend)(delayed(_sketch_frame_ranges_job)
+                                                                  (rec_arg, fr, relative_accuracy)
+                                                                  for fr in frame_ranges_jobs)
+    else:
+        sketches = [_sketch_frame_ranges_job(rec_arg, frame_ranges, relative_accuracy)]
+    sketch = sketches[0]
+    for other in sketches[1:]:
+        sketch.merge(other)
+
+    if key is not None:
+        _add_to_cache(key, sketch)
+    return sketch
+
+
+def set_recording_stats_cache_mb(max_mb):
+    """
+    Sets the memory budget (in Mb) of the cache of recording statistics and evicts the least recently used
+    statistics above the budget. With a budget of 0, the statistics are not cached.
+
+    Parameters
+    ----------
+    max_mb: float
+        The memory budget in Mb
+    """
+    global _max_cached_bytes
+    _max_cached_bytes = int(max_mb * 1e6)
+    _evict()
+
+
+def clear_recording_stats_cache():
+    """
+    Removes all the recording statistics and quantile sketches from the cache.
+    """
+    _recording_stats_cache.clear()
+
+
+def _add_to_cache(key, stats):
+    if stats.get_nbytes() > _max_cached_bytes:
+        return
+    _recording_stats_cache[key] = stats
+    _evict()
+
+
+def _evict():
+    while len(_recording_stats_cache) > 0 and \
+            (len(_recording_stats_cache) > _max_cached_stats or
+             sum(stats.get_nbytes() for stats in _recording_stats_cache.values()) > _max_cached_bytes):
+        _recording_stats_cache.popitem(last=False)
+
+
+def get_random_frame_ranges(num_frames, num_chunks=50, chunk_size=500, seed=0):
+    if chunk_size >= num_frames:
+        return [(0, num_frames)]
+    random_ints = np.random.RandomState(seed=seed).randint(0, num_frames - chunk_size, size=num_chunks)
+    return [(ff, ff + chunk_size) for ff in random_ints]
+
+
+def _read_frame_ranges(recording, frame_ranges, n_jobs, joblib_backend):
+    rec_arg, n_jobs = _get_rec_arg(recording, n_jobs)
+    if n_jobs > 1:
+        frame_ranges_jobs = [fr for fr in np.array_split(np.array(frame_ranges), n_jobs) if len(fr) > 0]
+        chunk_list = Parallel(n_jobs=n_jobs, backend=joblib_backend)(delayed(_read_frame_ranges_job)
+                                                                    (rec_arg, fr) for fr in frame_ranges_jobs)
+    else:
+        chunk_list = [_read_frame_ranges_job(rec_arg, frame_ranges)]
+    return np.concatenate(chunk_list, axis=1)
+
+
+def _get_rec_arg(recording, n_jobs):
+    if not recording.check_if_dumpable():
+        if n_jobs > 1:
+            n_jobs = 1
+            print("RecordingExtractor is not dumpable and can't be processed in parallel")
+        rec_arg = recording
+    else:
+        if n_jobs > 1:
+            rec_arg = recording.dump_to_dict()
+        else:
+            rec_arg = recording
+    return rec_arg, n_jobs
+
+
+def _read_frame_ranges_job(rec_arg, frame_ranges):
+    if isinstance(rec_arg, dict):
+        recording = se.load_extractor_from_dict(rec_arg)
+    else:
+        recording = rec_arg
+    chunk_list = []
+    for (start_frame, end_frame) in frame_ranges:
+        chunk_list.append(recording.get_traces(start_frame=int(start_frame), end_frame=int(end_frame)))
+    return np.concatenate(chunk_list, axis=1)
+
+
+def _sketch_frame_ranges_job(rec_arg, frame_ranges, relative_accuracy):
+    if isinstance(rec_arg, dict):
+        recording = se.load_extractor_from_dict(rec_arg)
+    else:
+        recording = rec_arg
+    sketch = QuantileSketch(relative_accuracy=relative_accuracy)
+    for (start_frame, end_frame) in frame_ranges:
+        sketch.add(recording.get_traces(start_frame=int(start_frame), end_frame=int(end_frame)))
+    return sketch
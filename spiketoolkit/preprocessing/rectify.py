@@ -6,15 +6,20 @@ import numpy as np
 
 class RectifyRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'Rectify'
+    _fusable = True
+    _elementwise = True
 
     def __init__(self, recording):
         BasePreprocessorRecordingExtractor.__init__(self, recording)
         self._kwargs = {'recording': recording.make_serialized_dict()}
 
     @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
-        return np.abs(self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame,
-                                                 return_scaled=return_scaled))
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True, out=None):
+        return self._get_elementwise_traces(channel_ids, start_frame, end_frame, return_scaled=return_scaled, out=out)
+
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        np.abs(traces, out=traces)
+        return traces
 
 
 def rectify(recording):
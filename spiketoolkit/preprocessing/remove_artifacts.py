@@ -3,13 +3,15 @@ from spikeextractors.extraction_tools import check_get_traces_args
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
 import numpy as np
 from scipy.interpolate import interp1d
+from functools import lru_cache
 
 
 class RemoveArtifactsRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'RemoveArtifacts'
 
     def __init__(self, recording, triggers, ms_before=0.5, ms_after=3.0, mode='zeros', fit_sample_spacing=1.):
-        self._triggers = np.array(triggers)
+        # triggers are sorted once so that the triggers of a chunk are found with searchsorted
+        self._triggers = np.sort(np.array(triggers))
         self._ms_before = ms_before
         self._ms_after = ms_after
         self._mode = mode
@@ -25,117 +27,175 @@ class RemoveArtifactsRecording(BasePreprocessorRecordingExtractor):
                                             start_frame=start_frame,
                                             end_frame=end_frame,
                                             return_scaled=return_scaled)
-        triggers = self._triggers[(self._triggers > start_frame) & (self._triggers < end_frame)] - start_frame
+        i1 = np.searchsorted(self._triggers, start_frame, side='right')
+        i2 = np.searchsorted(self._triggers, end_frame, side='left')
+        triggers = (self._triggers[i1:i2] - start_frame).astype(int)
 
         pad = [int(self._ms_before * self.get_sampling_frequency() / 1000),
                int(self._ms_after * self.get_sampling_frequency() / 1000)]
 
         traces = traces.copy()
+        if len(triggers) == 0:
+            return traces
         if self._mode == 'zeros':
-            for trig in triggers:
-                if trig - pad[0] > 0 and trig + pad[1] < end_frame - start_frame:
-                    traces[:, trig - pad[0]:trig + pad[1]] = 0
-                elif trig - pad[0] <= 0 and trig + pad[1] >= end_frame - start_frame:
-                    traces = 0
-                elif trig - pad[0] <= 0:
-                    traces[:, :trig + pad[1]] = 0
-                elif trig + pad[1] >= end_frame - start_frame:
-                    traces[:, trig - pad[0]:] = 0
+            # all the artifact periods are zeroed with a single mask
+            num_frames = traces.shape[1]
+            bounds = np.zeros(num_frames + 1, dtype=int)
+            np.add.at(bounds, np.clip(triggers - pad[0], 0, num_frames), 1)
+            np.add.at(bounds, np.clip(triggers + pad[1], 0, num_frames), -1)
+            traces[:, np.cumsum(bounds[:-1]) > 0] = 0
         else:
-            sample_freq = self._recording.get_sampling_frequency()
-
-            # generate indices for evenly spaced fit points before and after gap
-            fit_sample_range = int(((sample_freq / 1000) * self._fit_sample_spacing * 2) + 1)
-            fit_sample_interval = int(self._fit_sample_spacing * (sample_freq / 1000))
-
-            fit_samples = np.array(range(0, fit_sample_range, fit_sample_interval))
-            rev_fit_samples = fit_sample_range - fit_samples
-            triggers = np.array(triggers).astype(int)
-            for trig in triggers:
-                pre_data_end_idx = trig - pad[0] - 1
-                post_data_start_idx = trig + pad[1] + 1
-
-                # Generate fit points from the sample points determined
-                pre_idx = pre_data_end_idx - rev_fit_samples + 1
-                post_idx = post_data_start_idx + fit_samples
-
-                # Get indices of the gap to fill
-                gap_idx = np.array(range(pre_data_end_idx + 1, post_data_start_idx + 0))
-
-                # Make sure we are not going out of bounds
-                gap_idx = gap_idx[gap_idx >= 0]
-                gap_idx = gap_idx[gap_idx < len(traces[0])]
-
-                # correct for out of bounds indices on both sides:
-                if np.max(post_idx) >= len(traces[0]):
-                    post_idx = post_idx[post_idx < len(traces[0])]
-
-                if np.min(pre_idx) < 0:
-                    pre_idx = pre_idx[pre_idx >= 0]
-
-                # fit x values                
-                all_idx = np.hstack((pre_idx, post_idx))
-
-                # fit y values
-                interp_traces = traces[:, all_idx]
-
-                # Get the median value from 5 samples around each fit point
-                # for robustness to noise / small fluctuations
-                pre_vals = np.empty((0, len(traces)), 'int32')
-                for idx in iter(pre_idx):
-                    if idx == pre_idx[-1]:
-                        idxs = np.array(range(idx - 3, idx + 1))
-                    else:
-                        idxs = np.array(range(idx - 2, idx + 3))
-
-                    if np.min(idx) < 0:
-                        idx = idx[idx >= 0]
-
-                    median_vals = np.median(traces[:, idxs], axis=1)
-                    pre_vals = np.vstack((pre_vals, median_vals))
-
-                post_vals = np.empty((0, len(traces)), 'int32')
-                for idx in iter(post_idx):
-                    if idx == post_idx[0]:
-                        idxs = np.array(range(idx, idx + 4))
-                    else:
-                        idxs = np.array(range(idx - 2, idx + 3))
-
-                    if np.max(idx) >= len(traces[0]):
-                        idx = idx[idx < len(traces[0])]
-
-                    median_vals = np.median(traces[:, idxs], axis=1)
-                    post_vals = np.vstack((post_vals, median_vals))
-
-                interp_traces = np.vstack((pre_vals, post_vals)).T
-
-                if self._mode == 'cubic' and len(all_idx) >= 5:
-                    # Enough fit points present on either side to do cubic spline fit:
-                    interp_function = interp1d(all_idx, interp_traces, self._mode,
-                                               bounds_error=False,
-                                               fill_value='extrapolate')
-                    traces[:, gap_idx] = interp_function(gap_idx)
-                elif self._mode == 'linear' and len(all_idx) >= 2:
-                    # Enough fit points present for a linear fit
-                    interp_function = interp1d(all_idx, interp_traces, self._mode, bounds_error=False,
-                                               fill_value='extrapolate')
-                    traces[:, gap_idx] = interp_function(gap_idx)
-                elif len(pre_idx) > len(post_idx):
-                    # not enough fit points, fill with nearest neighbour on side with the most data points
-                    traces[:, gap_idx] = np.repeat(traces[:, pre_idx[-1]] * np.ones((1, 1)), len(gap_idx), 0).T
-                elif len(post_idx) > len(pre_idx):
-                    # not enough fit points, fill with nearest neighbour on side with the most data points
-                    traces[:, gap_idx] = np.repeat(traces[:, post_idx[0]] * np.ones((1, 1)), len(gap_idx), 0).T
-                elif len(all_idx) > 0:
-                    # not enough fit points, both sides tied for most data points, fill with last pre value
-                    traces[:, gap_idx] = np.repeat(traces[:, pre_idx[-1]] * np.ones((1, 1)), len(gap_idx), 0).T
-                else:
-                    # No data to interpolate from on either side of gap;
-                    # Fill with zeros
-                    traces[:, gap_idx] = 0
+            self._interpolate_artifacts(traces, triggers, pad)
 
         return traces
 
+    def _interpolate_artifacts(self, traces, triggers, pad):
+        sample_freq = self._recording.get_sampling_frequency()
+        num_frames = traces.shape[1]
+
+        # generate indices for evenly spaced fit points before and after gap
+        fit_sample_range = int(((sample_freq / 1000) * self._fit_sample_spacing * 2) + 1)
+        fit_sample_interval = int(self._fit_sample_spacing * (sample_freq / 1000))
+
+        fit_samples = np.array(range(0, fit_sample_range, fit_sample_interval))
+        rev_fit_samples = fit_sample_range - fit_samples
+
+        # fit points (and the samples around them) relative to the trigger
+        pre_offsets = - pad[0] - rev_fit_samples
+        post_offsets = pad[1] + 1 + fit_samples
+        first_read = triggers + pre_offsets[0] - 3
+        last_read = triggers + post_offsets[-1] + 3
+        # the fit points of interior triggers are inside the traces and can be processed in batch
+        interior = (first_read >= 0) & (last_read < num_frames)
+        num_fit_points = 2 * len(fit_samples)
+        if not (self._mode == 'cubic' and num_fit_points >= 5 or self._mode == 'linear' and num_fit_points >= 2):
+            # not enough fit points for an interpolation
+            interior[:] = False
+
+        # a trigger whose fit points fall in the gap of the previous trigger must see the interpolated gap and
+        # starts a new batch
+        post_data_start = triggers + pad[1] + 1
+        i = 0
+        while i < len(triggers):
+            if not interior[i]:
+                self._interpolate_trigger(traces, triggers[i], pad, fit_samples, rev_fit_samples)
+                i += 1
+                continue
+            j = i + 1
+            while j < len(triggers) and interior[j] and first_read[j] >= post_data_start[j - 1]:
+                j += 1
+            self._interpolate_batch(traces, triggers[i:j], pad, pre_offsets, post_offsets)
+            i = j
+
+    def _interpolate_batch(self, traces, triggers, pad, pre_offsets, post_offsets):
+        # fit values: median of 4 samples at the fit points next to the gap and of 5 samples at the others, for
+        # robustness to noise / small fluctuations
+        pre_windows = np.concatenate([pre_offsets[:-1, np.newaxis] + np.arange(-2, 3)[np.newaxis],
+                                      np.tile(pre_offsets[-1] + np.arange(-3, 2), (1, 1))])
+        post_windows = np.concatenate([np.tile(post_offsets[0] + np.arange(-1, 4), (1, 1)),
+                                       post_offsets[1:, np.newaxis] + np.arange(-2, 3)[np.newaxis]])
+        windows = np.concatenate([pre_windows, post_windows])
+        samples = traces[:, triggers[:, np.newaxis, np.newaxis] + windows[np.newaxis]]
+        fit_values = np.median(samples, axis=-1)
+        # windows next to the gap have 4 samples: the extra sample is excluded
+        last_pre = len(pre_offsets) - 1
+        fit_values[:, :, last_pre] = np.median(samples[:, :, last_pre, :-1], axis=-1)
+        fit_values[:, :, last_pre + 1] = np.median(samples[:, :, last_pre + 1, 1:], axis=-1)
+
+        # the interpolation is linear in the fit values and the same for all the triggers
+        gap_offsets = np.arange(-pad[0], pad[1] + 1)
+        fit_offsets = np.concatenate([pre_offsets, post_offsets])
+        interp_matrix = _get_interpolation_matrix(tuple(fit_offsets), tuple(gap_offsets), self._mode)
+        traces[:, triggers[:, np.newaxis] + gap_offsets[np.newaxis]] = fit_values @ interp_matrix
+
+    def _interpolate_trigger(self, traces, trig, pad, fit_samples, rev_fit_samples):
+        pre_data_end_idx = trig - pad[0] - 1
+        post_data_start_idx = trig + pad[1] + 1
+
+        # Generate fit points from the sample points determined
+        pre_idx = pre_data_end_idx - rev_fit_samples + 1
+        post_idx = post_data_start_idx + fit_samples
+
+        # Get indices of the gap to fill
+        gap_idx = np.array(range(pre_data_end_idx + 1, post_data_start_idx + 0))
+
+        # Make sure we are not going out of bounds
+        gap_idx = gap_idx[gap_idx >= 0]
+        gap_idx = gap_idx[gap_idx < len(traces[0])]
+
+        # correct for out of bounds indices on both sides:
+        if np.max(post_idx) >= len(traces[0]):
+            post_idx = post_idx[post_idx < len(traces[0])]
+
+        if np.min(pre_idx) < 0:
+            pre_idx = pre_idx[pre_idx >= 0]
+
+        # fit x values
+        all_idx = np.hstack((pre_idx, post_idx))
+
+        # Get the median value from 5 samples around each fit point
+        # for robustness to noise / small fluctuations
+        pre_vals = np.empty((0, len(traces)), 'int32')
+        for idx in iter(pre_idx):
+            if idx == pre_idx[-1]:
+                idxs = np.array(range(idx - 3, idx + 1))
+            else:
+                idxs = np.array(range(idx - 2, idx + 3))
+            idxs = idxs[(idxs >= 0) & (idxs < len(traces[0]))]
+
+            median_vals = np.median(traces[:, idxs], axis=1)
+            pre_vals = np.vstack((pre_vals, median_vals))
+
+        post_vals = np.empty((0, len(traces)), 'int32')
+        for idx in iter(post_idx):
+            if idx == post_idx[0]:
+                idxs = np.array(range(idx, idx + 4))
+            else:
+                idxs = np.array(range(idx - 2, idx + 3))
+            idxs = idxs[(idxs >= 0) & (idxs < len(traces[0]))]
+
+            median_vals = np.median(traces[:, idxs], axis=1)
+            post_vals = np.vstack((post_vals, median_vals))
+
+        interp_traces = np.vstack((pre_vals, post_vals)).T
+
+        if self._mode == 'cubic' and len(all_idx) >= 5:
+            # Enough fit points present on either side to do cubic spline fit:
+            interp_function = interp1d(all_idx, interp_traces, self._mode,
+                                       bounds_error=False,
+                                       fill_value='extrapolate')
+            traces[:, gap_idx] = interp_function(gap_idx)
+        elif self._mode == 'linear' and len(all_idx) >= 2:
+            # Enough fit points present for a linear fit
+            interp_function = interp1d(all_idx, interp_traces, self._mode, bounds_error=False,
+                                       fill_value='extrapolate')
+            traces[:, gap_idx] = interp_function(gap_idx)
+        elif len(pre_idx) > len(post_idx):
+            # not enough fit points, fill with nearest neighbour on side with the most data points
+            traces[:, gap_idx] = np.repeat(traces[:, pre_idx[-1]] * np.ones((1, 1)), len(gap_idx), 0).T
+        elif len(post_idx) > len(pre_idx):
+            # not enough fit points, fill with nearest neighbour on side with the most data points
+            traces[:, gap_idx] = np.repeat(traces[:, post_idx[0]] * np.ones((1, 1)), len(gap_idx), 0).T
+        elif len(all_idx) > 0:
+            # not enough fit points, both sides tied for most data points, fill with last pre value
+            traces[:, gap_idx] = np.repeat(traces[:, pre_idx[-1]] * np.ones((1, 1)), len(gap_idx), 0).T
+        else:
+            # No data to interpolate from on either side of gap;
+            # Fill with zeros
+            traces[:, gap_idx] = 0
+
+
+@lru_cache(maxsize=32)
+def _get_interpolation_matrix(fit_offsets, gap_offsets, mode):
+    # (num_fit_points, num_gap_samples) matrix giving the interpolated gap from the fit values: the interpolation of
+    # each row of the identity is the contribution of one fit point
+    num_fit_points = len(fit_offsets)
+    interp_function = interp1d(fit_offsets, np.eye(num_fit_points), mode, bounds_error=False,
+                               fill_value='extrapolate')
+    interp_matrix = interp_function(gap_offsets)
+    interp_matrix.flags.writeable = False
+    return interp_matrix
+
 
 def remove_artifacts(recording, triggers, ms_before=0.5, ms_after=3, mode='zeros', fit_sample_spacing=1.):
     '''
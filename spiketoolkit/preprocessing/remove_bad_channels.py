@@ -1,21 +1,32 @@
 from spikeextractors import RecordingExtractor, SubRecordingExtractor
 from spikeextractors.extraction_tools import check_get_traces_args
 from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+from .recording_stats import get_recording_stats
 import numpy as np
 
 
 class RemoveBadChannelsRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'RemoveBadChannels'
 
-    def __init__(self, recording, bad_channel_ids, bad_threshold, seconds, verbose):
+    def __init__(self, recording, bad_channel_ids, bad_threshold, seconds, verbose, method='std', n_segments=10,
+                 local_radius=None, n_jobs=1, joblib_backend='loky'):
+        assert method in ['std', 'features'], "'method' can be 'std' or 'features'"
         self._bad_channel_ids = bad_channel_ids
         self._bad_threshold = bad_threshold
         self._seconds = seconds
+        self._method = method
+        self._n_segments = n_segments
+        self._local_radius = local_radius
+        self._n_jobs = n_jobs
+        self._joblib_backend = joblib_backend
+        self.bad_channel_features = None
         self.verbose = verbose
         self._initialize_subrecording_extractor(recording)
         BasePreprocessorRecordingExtractor.__init__(self, self._subrecording)
         self._kwargs = {'recording': recording.make_serialized_dict(), 'bad_channel_ids': bad_channel_ids,
-                        'bad_threshold': bad_threshold, 'seconds': seconds, 'verbose': verbose}
+                        'bad_threshold': bad_threshold, 'seconds': seconds, 'verbose': verbose, 'method': method,
+                        'n_segments': n_segments, 'local_radius': local_radius, 'n_jobs': n_jobs,
+                        'joblib_backend': joblib_backend}
 
     @check_get_traces_args
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
@@ -31,13 +42,10 @@ class RemoveBadChannelsRecording(BasePreprocessorRecordingExtractor):
                     active_channels.append(chan)
             self._subrecording = SubRecordingExtractor(recording, channel_ids=active_channels)
         elif self._bad_channel_ids is None:
-            start_frame = recording.get_num_frames() // 2
-            end_frame = int(start_frame + self._seconds * recording.get_sampling_frequency())
-            if end_frame > recording.get_num_frames():
-                end_frame = recording.get_num_frames()
-            traces = recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-            stds = np.std(traces, axis=1)
-            bad_channel_ids = [ch for ch, std in enumerate(stds) if std > self._bad_threshold * np.median(stds)]
+            if self._method == 'std':
+                bad_channel_ids = self._detect_bad_channels_std(recording)
+            else:
+                bad_channel_ids = self._detect_bad_channels_features(recording)
             if self.verbose:
                 print('Automatically removing channels:', bad_channel_ids)
             active_channels = []
@@ -49,8 +57,77 @@ class RemoveBadChannelsRecording(BasePreprocessorRecordingExtractor):
             self._subrecording = recording
         self.active_channels = self._subrecording.get_channel_ids()
 
+    def _detect_bad_channels_std(self, recording):
+        start_frame = recording.get_num_frames() // 2
+        end_frame = int(start_frame + self._seconds * recording.get_sampling_frequency())
+        if end_frame > recording.get_num_frames():
+            end_frame = recording.get_num_frames()
+        stds = get_recording_stats(recording, frame_ranges=[(start_frame, end_frame)]).get_std()
+        return [ch for ch, std in zip(recording.get_channel_ids(), stds) if std > self._bad_threshold * np.median(stds)]
 
-def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, seconds=10, verbose=False):
+    def _detect_bad_channels_features(self, recording):
+        # 'n_segments' segments evenly spread over the recording, with a total duration of 'seconds'
+        num_frames = recording.get_num_frames()
+        segment_size = int(self._seconds * recording.get_sampling_frequency() / self._n_segments)
+        if segment_size * self._n_segments >= num_frames:
+            boundaries = np.linspace(0, num_frames, self._n_segments + 1).astype(int)
+            frame_ranges = list(zip(boundaries[:-1], boundaries[1:]))
+        else:
+            start_frames = np.linspace(0, num_frames - segment_size, self._n_segments).astype(int)
+            frame_ranges = [(sf, sf + segment_size) for sf in start_frames]
+        stats = get_recording_stats(recording, frame_ranges=frame_ranges, n_jobs=self._n_jobs,
+                                    joblib_backend=self._joblib_backend)
+        split_idxs = np.cumsum([end - start for (start, end) in stats.frame_ranges])[:-1]
+        segments = np.split(stats.get_traces(), split_idxs, axis=1)
+
+        if self._local_radius is not None and 'location' in recording.get_shared_channel_property_names():
+            locations = np.array(recording.get_channel_locations())
+            distances = np.linalg.norm(locations[:, np.newaxis] - locations[np.newaxis], axis=2)
+            neighbors = (distances <= self._local_radius) & (distances > 0)
+        else:
+            neighbors = None
+        self.bad_channel_features = _compute_bad_channel_features(segments, neighbors)
+
+        features = self.bad_channel_features
+        bad = (features['std'] > self._bad_threshold * np.median(features['std'])) | \
+              (features['std'] < np.median(features['std']) / self._bad_threshold) | \
+              (features['mad'] > self._bad_threshold * np.median(features['mad'])) | \
+              (features['hf_power'] > self._bad_threshold * np.median(features['hf_power']))
+        if 'neighbor_corr' in features:
+            median_corr = np.median(features['neighbor_corr'])
+            # the correlation is only informative if it is above its noise floor
+            if median_corr > 3 / np.sqrt(np.min([seg.shape[1] for seg in segments])):
+                bad |= features['neighbor_corr'] < median_corr / self._bad_threshold
+        return [ch for ch, is_bad in zip(recording.get_channel_ids(), bad) if is_bad]
+
+
+def _compute_bad_channel_features(segments, neighbors=None):
+    # features are computed per segment for all channels at once and the median over the segments is kept
+    stds, mads, hf_powers, neighbor_corrs = [], [], [], []
+    for traces in segments:
+        traces = traces.astype('float64', copy=False)
+        std = np.std(traces, axis=1)
+        stds.append(std)
+        mads.append(np.median(np.abs(traces - np.median(traces, axis=1, keepdims=True)), axis=1) / 0.6745)
+        # power of the first difference relative to the signal power (~2 for white noise, lower for neural data)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hf_powers.append(np.nan_to_num(np.var(np.diff(traces, axis=1), axis=1) / std ** 2))
+            if neighbors is not None:
+                corr = np.nan_to_num(np.corrcoef(traces))
+                num_neighbors = np.sum(neighbors, axis=1)
+                neighbor_corrs.append(np.where(num_neighbors > 0, np.sum(corr * neighbors, axis=1) /
+                                               np.maximum(num_neighbors, 1), np.nan))
+    features = {'std': np.median(stds, axis=0), 'mad': np.median(mads, axis=0),
+                'hf_power': np.median(hf_powers, axis=0)}
+    if neighbors is not None:
+        neighbor_corr = np.median(neighbor_corrs, axis=0)
+        # channels without neighbors are not evaluated
+        features['neighbor_corr'] = np.where(np.isnan(neighbor_corr), np.nanmedian(neighbor_corr), neighbor_corr)
+    return features
+
+
+def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, seconds=10, method='std', n_segments=10,
+                        local_radius=None, n_jobs=1, joblib_backend='loky', verbose=False):
     '''
     Remove bad channels from the recording extractor.
 
@@ -59,11 +136,28 @@ def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, second
     recording: RecordingExtractor
         The recording extractor object
     bad_channel_ids: list
-        List of bad channel ids (int). If None, automatic removal will be done based on standard deviation.
+        List of bad channel ids (int). If None, automatic removal will be done based on 'method'.
     bad_threshold: float
         If automatic is used, the threshold for the standard deviation over which channels are removed
+        (relative to the median across channels)
     seconds: float
         If automatic is used, the number of seconds used to compute standard deviations
+    method: str
+        'std' (default): channels with large standard deviation in a block from the middle of the recording are
+        removed.
+        'features': standard deviation, MAD, high-frequency power and neighbor correlation are computed on
+        'n_segments' segments spread over the recording. Channels with std, MAD or high-frequency power larger
+        than 'bad_threshold' times the median, std lower than the median divided by 'bad_threshold', or neighbor
+        correlation lower than the median divided by 'bad_threshold', are removed.
+    n_segments: int
+        If method is 'features', the number of segments in which the 'seconds' are divided
+    local_radius: float or None
+        If method is 'features', channels within this distance are neighbors (requires channel locations).
+        If None, the neighbor correlation is not used
+    n_jobs: int
+        If method is 'features', number of jobs used to read the segments
+    joblib_backend: str
+        The backend for joblib
     verbose: bool
         If True, output is verbose
 
@@ -74,4 +168,6 @@ def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, second
 
     '''
     return RemoveBadChannelsRecording(recording=recording, bad_channel_ids=bad_channel_ids,
-                                      bad_threshold=bad_threshold, seconds=seconds, verbose=verbose)
+                                      bad_threshold=bad_threshold, seconds=seconds, verbose=verbose, method=method,
+                                      n_segments=n_segments, local_radius=local_radius, n_jobs=n_jobs,
+                                      joblib_backend=joblib_backend)
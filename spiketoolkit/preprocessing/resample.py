@@ -1,6 +1,6 @@
-from spikeextractors import RecordingExtractor
-from spikeextractors.extraction_tools import check_get_traces_args
-from .basepreprocessorrecording import BasePreprocessorRecordingExtractor
+from .filterrecording import FilterRecording
+from fractions import Fraction
+from functools import lru_cache
 import numpy as np
 from warnings import warn
 
@@ -12,16 +12,33 @@ except ImportError:
     HAVE_RR = False
 
 
-class ResampleRecording(BasePreprocessorRecordingExtractor):
+class ResampleRecording(FilterRecording):
     preprocessor_name = 'Resample'
     installed = HAVE_RR  # check at class level if installed or not
     installation_mesg = "To use the ResampleRecording, install scipy: \n\n pip install scipy\n\n"  # err
+    _fusable = False
 
-    def __init__(self, recording, resample_rate):
+    def __init__(self, recording, resample_rate, chunk_size=30000, cache_chunks=False, cache_mb=None,
+                 cache_folder=None):
         assert HAVE_RR, "To use the ResampleRecording, install scipy: \n\n pip install scipy\n\n"
-        self._resample_rate = resample_rate
-        BasePreprocessorRecordingExtractor.__init__(self, recording, copy_times=False)
-        self._dtype = recording.get_dtype()
+        # rational approximation of the resampling ratio
+        ratio = Fraction(resample_rate / recording.get_sampling_frequency()).limit_denominator(1000)
+        self._up = ratio.numerator
+        self._down = ratio.denominator
+        # the output sampling frequency and number of frames are those of the approximated ratio
+        self._resample_rate = recording.get_sampling_frequency() * self._up / self._down
+        if not np.isclose(self._resample_rate, resample_rate, rtol=1e-9, atol=0):
+            warn(f"The resampling ratio is approximated by {self._up}/{self._down}: the sampling frequency is "
+                 f"{self._resample_rate} instead of {resample_rate}")
+        # padding (in frames of the parent recording) covering the polyphase filter, multiple of 'down' so that the
+        # padded chunks start on output frames
+        half_len = 10 * max(self._up, self._down)
+        self._padding = int(np.ceil((half_len / self._up + 1) / self._down)) * self._down
+        if chunk_size is not None:
+            # chunks start on output frames that are multiple of 'up', which fall on frames of the parent recording
+            chunk_size = int(np.ceil(chunk_size / self._up)) * self._up
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 cache_mb=cache_mb, cache_folder=cache_folder, copy_times=False)
 
         if recording._times is not None:
             # resample timestamps uniformly
@@ -29,17 +46,15 @@ class ResampleRecording(BasePreprocessorRecordingExtractor):
             resampled_times = np.linspace(recording._times[0], recording._times[-1], self.get_num_frames())
             self.set_times(resampled_times)
 
-        self._kwargs = {'recording': recording.make_serialized_dict(), 'resample_rate': resample_rate}
+        self._kwargs = {'recording': recording.make_serialized_dict(), 'resample_rate': resample_rate,
+                        'chunk_size': chunk_size, 'cache_chunks': cache_chunks, 'cache_mb': cache_mb,
+                        'cache_folder': cache_folder}
 
     def get_sampling_frequency(self):
         return self._resample_rate
 
     def get_num_frames(self):
-        return int(self._recording.get_num_frames() / self._recording.get_sampling_frequency() * self._resample_rate)
-
-    # avoid filtering one sample
-    def get_dtype(self, return_scaled=True):
-        return self._dtype
+        return self._recording.get_num_frames() * self._up // self._down
 
     # need to override frame_to_time and time_to_frame because self._recording might not have "times"
     def frame_to_time(self, frames):
@@ -54,35 +69,61 @@ class ResampleRecording(BasePreprocessorRecordingExtractor):
         else:
             return self._recording.time_to_frame(times)
 
-
-    @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
-        start_frame_not_sampled = int(start_frame / self.get_sampling_frequency() *
-                                      self._recording.get_sampling_frequency())
-        start_frame_sampled = start_frame
-        end_frame_not_sampled = int(end_frame / self.get_sampling_frequency() *
-                                    self._recording.get_sampling_frequency())
-        end_frame_sampled = end_frame
-        traces = self._recording.get_traces(start_frame=start_frame_not_sampled,
-                                            end_frame=end_frame_not_sampled,
-                                            channel_ids=channel_ids,
-                                            return_scaled=return_scaled)
-        traces_resampled = signal.resample(traces, int(end_frame_sampled - start_frame_sampled), axis=1)
-
-        return traces_resampled.astype(self._dtype)
-
-
-def resample(recording, resample_rate):
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids, return_scaled=True):
+        up = self._up
+        down = self._down
+        # output frame 'aligned_start' corresponds to the frame 'aligned_start // up * down' of the parent recording
+        aligned_start = start_frame - start_frame % up
+        i1 = aligned_start // up * down - self._padding
+        i2 = int(np.ceil(end_frame * down / up)) + self._padding
+        padded_chunk = self._read_chunk(i1, i2, channel_ids, return_scaled)
+        resampled_padded_chunk = self._do_filter(padded_chunk)
+        offset = self._padding // down * up + start_frame - aligned_start
+        return resampled_padded_chunk[:, offset:offset + end_frame - start_frame]
+
+    def _do_filter(self, chunk):
+        if self._up == self._down:
+            # same sampling rate (the ratio is reduced, so up == down == 1): no anti-aliasing filter
+            return np.array(chunk)
+        return signal.resample_poly(chunk, self._up, self._down, axis=1, window=_get_resample_taps(self._up,
+                                                                                                   self._down))
+
+
+@lru_cache(maxsize=32)
+def _get_resample_taps(up, down):
+    # same anti-aliasing filter as the default of scipy.signal.resample_poly
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    taps = signal.firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0))
+    taps.flags.writeable = False
+    return taps
+
+
+def resample(recording, resample_rate, chunk_size=30000, cache_chunks=False, cache_mb=None, cache_folder=None):
     '''
-    Resamples the recording extractor traces. If the resampling rate is multiple of the sampling rate, the faster
-    scipy decimate function is used.
+    Resamples the recording extractor traces with a polyphase filter (scipy resample_poly). The resampling ratio is
+    approximated by a fraction up / down (with down <= 1000) and the traces are resampled in chunks aligned on the
+    frames of the original recording, so that the output does not depend on the requested window. The sampling
+    frequency and the number of frames of the resampled recording are those of the approximated ratio (a warning is
+    raised if the sampling frequency differs from 'resample_rate').
 
     Parameters
     ----------
     recording: RecordingExtractor
         The recording extractor to be resampled
     resample_rate: int or float
-        The resampling frequency
+        The resampling frequency. The resampled recording has the sampling frequency
+        recording.get_sampling_frequency() * up / down of the approximated ratio
+    chunk_size: int or None
+        The chunk size (in resampled frames) to be used for the resampling. It is rounded up to a multiple of 'up'
+    cache_chunks: bool or 'shared' (default False).
+        If True then each chunk is cached in memory in a least-recently-used cache of 'cache_mb' Mb.
+        If 'shared', chunks are cached in the process-wide cache shared by all filter recordings
+    cache_mb: float or None
+        Memory budget in Mb of the chunk cache when cache_chunks is True (default 800 Mb)
+    cache_folder: str, Path, or None
+        If given, resampled chunks are also cached on disk in a sub-folder of 'cache_folder' identified by the hash of
+        the preprocessing chain, so that they are reused by other processes (the recording must be dumpable)
 
     Returns
     -------
@@ -92,5 +133,9 @@ def resample(recording, resample_rate):
     '''
     return ResampleRecording(
         recording=recording,
-        resample_rate=resample_rate
+        resample_rate=resample_rate,
+        chunk_size=chunk_size,
+        cache_chunks=cache_chunks,
+        cache_mb=cache_mb,
+        cache_folder=cache_folder
     )
@@ -6,6 +6,8 @@ import numpy as np
 
 class TransformRecording(BasePreprocessorRecordingExtractor):
     preprocessor_name = 'Transform'
+    _fusable = True
+    _elementwise = True
 
     def __init__(self, recording, scalar=1., offset=0., dtype=None):
         if not isinstance(recording, RecordingExtractor):
@@ -23,30 +25,42 @@ class TransformRecording(BasePreprocessorRecordingExtractor):
                         'dtype': dtype}
 
     @check_get_traces_args
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True):
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None, return_scaled=True, out=None):
         assert return_scaled, "'transform' only supports return_scaled=True"
+        return self._get_elementwise_traces(channel_ids, start_frame, end_frame, out=out)
 
-        traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame,
-                                            return_scaled=return_scaled)
+    def _get_elementwise_dtype(self, dtype):
+        return self._dtype
+
+    def _get_elementwise_affine(self, channel_ids):
+        return self._get_scalar_and_offset(channel_ids)
+
+    def _fused_apply(self, traces, channel_ids, start_frame):
+        scalar, offset = self._get_scalar_and_offset(channel_ids)
+        traces *= scalar
+        traces += offset
+        return traces
+
+    def _get_scalar_and_offset(self, channel_ids):
         if isinstance(self._scalar, (int, float, np.integer, np.float)):
-            traces = traces*self._scalar
+            scalar = self._scalar
         else:
             if len(self._scalar) == len(channel_ids):
                 scalar = np.array(self._scalar)
             else:
                 channel_idxs = np.array([self._recording.get_channel_ids().index(ch) for ch in channel_ids])
                 scalar = np.array(self._scalar)[channel_idxs]
-            traces = traces * scalar[:, np.newaxis]
+            scalar = scalar[:, np.newaxis]
         if isinstance(self._offset, (int, float, np.integer, np.float)):
-            traces = traces + self._offset
+            offset = self._offset
         else:
             if len(self._offset) == len(channel_ids):
                 offset = np.array(self._offset)
             else:
                 channel_idxs = np.array([self._recording.get_channel_ids().index(ch) for ch in channel_ids])
                 offset = np.array(self._offset)[channel_idxs]
-            traces = traces + offset[:, np.newaxis]
-        return traces.astype(self._dtype)
+            offset = offset[:, np.newaxis]
+        return scalar, offset
 
 
 def transform(recording, scalar=1, offset=0):
@@ -1,52 +1,200 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, EXECUTION_KWARGS
+from .recording_stats import get_recording_stats
+from ..utils import get_recording_hash
+from joblib import Parallel, delayed
+from collections import OrderedDict
+from pathlib import Path
+import spikeextractors as se
 import numpy as np
+import scipy.sparse as sparse
+
+# whitening matrices computed in this process, by preprocessing chain and estimation parameters (least recently used
+# matrices are evicted)
+_whitening_matrix_cache = OrderedDict()
+_max_cached_matrices = 8
 
 
 class WhitenRecording(FilterRecording):
     preprocessor_name = 'Whiten'
+    _mixes_channels = True
+    _chunk_statistics = True
 
-    def __init__(self, recording, chunk_size=30000, cache_chunks=False, seed=0):
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
-        self._whitening_matrix = self._compute_whitening_matrix(seed=seed)
+    def __init__(self, recording, chunk_size=30000, cache_chunks=False, cache_mb=None, cache_folder=None, seed=0,
+                 fraction=None, local_radius=None, n_jobs=1, joblib_backend='loky'):
+        self._padding = 0
+        self._local_radius = local_radius
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 cache_mb=cache_mb, cache_folder=cache_folder)
+        self._whitening_matrix = self._get_whitening_matrix(recording, seed=seed, fraction=fraction,
+                                                            n_jobs=n_jobs, joblib_backend=joblib_backend)
         self.has_unscaled = False
         self._kwargs = {'recording': recording.make_serialized_dict(), 'chunk_size': chunk_size,
-                        'cache_chunks': cache_chunks, 'seed': seed}
-
-    def _get_random_data_for_whitening(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
-
-    def _compute_whitening_matrix(self, seed):
-        data = self._get_random_data_for_whitening(seed=seed)
-        
-        # center the data
-        data = data - np.mean(data, axis=1, keepdims=True)
-        
-        # Original by Jeremy
-        AAt = data @ np.transpose(data)
-        AAt = AAt / data.shape[1]
-        U, S, Ut = np.linalg.svd(AAt, full_matrices=True)
-        W = (U @ np.diag(1 / np.sqrt(S))) @ Ut
-        
+                        'cache_chunks': cache_chunks, 'cache_mb': cache_mb, 'cache_folder': cache_folder,
+                        'seed': seed, 'fraction': fraction, 'local_radius': local_radius, 'n_jobs': n_jobs,
+                        'joblib_backend': joblib_backend}
+
+    def _get_whitening_matrix(self, recording, seed, fraction, n_jobs, joblib_backend):
+        if fraction is None:
+            key = 'seed{}'.format(seed)
+        else:
+            assert 0 < fraction <= 1, "'fraction' must be in (0, 1]"
+            key = 'fraction{}_chunk{}'.format(fraction, self._get_covariance_chunk_size())
+        if self._local_radius is not None:
+            key += '_radius{}'.format(self._local_radius)
+        if recording.check_if_dumpable():
+            key = get_recording_hash(recording, ignore_kwargs=EXECUTION_KWARGS) + '_' + key
+        else:
+            key = None
+
+        if key is not None and key in _whitening_matrix_cache:
+            _whitening_matrix_cache.move_to_end(key)
+            return _whitening_matrix_cache[key]
+        if key is not None and self._cache_folder is not None:
+            matrix_file = Path(self._cache_folder) / 'whitening_{}.npy'.format(key)
+            if matrix_file.is_file():
+                W = np.load(matrix_file)
+                if self._local_radius is not None:
+                    W = sparse.csr_matrix(W)
+                _add_to_cache(key, W)
+                return W
+        else:
+            matrix_file = None
+
+        if fraction is None:
+            covariance = self._compute_random_covariance(seed=seed)
+        else:
+            covariance = self._compute_covariance(fraction, n_jobs, joblib_backend)
+        if self._local_radius is None:
+            W = _get_whitening_from_covariance(covariance)
+        else:
+            W = _get_local_whitening_from_covariance(covariance, self._get_neighborhoods())
+
+        if key is not None:
+            _add_to_cache(key, W)
+            if matrix_file is not None:
+                matrix_file.parent.mkdir(parents=True, exist_ok=True)
+                np.save(matrix_file, W.toarray() if sparse.issparse(W) else W)
         return W
 
+    def _get_neighborhoods(self):
+        # each neighborhood contains the channel and the channels within 'local_radius'
+        locations = np.array(self._recording.get_channel_locations())
+        distances = np.linalg.norm(locations[:, np.newaxis] - locations[np.newaxis], axis=2)
+        return [np.nonzero(distances[i] <= self._local_radius)[0] for i in range(len(locations))]
+
+    def _get_covariance_chunk_size(self):
+        if self._chunk_size is None:
+            return 30000
+        return self._chunk_size
+
+    def _compute_covariance(self, fraction, n_jobs, joblib_backend):
+        # chunks evenly spaced over the recording and covering 'fraction' of it
+        chunk_size = self._get_covariance_chunk_size()
+        start_frames = np.arange(0, self._recording.get_num_frames(), chunk_size)
+        num_selected = max(1, int(np.round(fraction * len(start_frames))))
+        start_frames = start_frames[np.unique(np.linspace(0, len(start_frames) - 1, num_selected).astype(int))]
+
+        if not self._recording.check_if_dumpable():
+            if n_jobs > 1:
+                n_jobs = 1
+                print("RecordingExtractor is not dumpable and can't be processed in parallel")
+            rec_arg = self._recording
+        else:
+            if n_jobs > 1:
+                rec_arg = self._recording.dump_to_dict()
+            else:
+                rec_arg = self._recording
+
+        if n_jobs > 1:
+            start_frames_jobs = [sf for sf in np.array_split(start_frames, n_jobs) if len(sf) > 0]
+            outputs = Parallel(n_jobs=n_jobs, backend=joblib_backend)(delayed(_accumulate_covariance)
+                                                                     (rec_arg, sf, chunk_size)
+                                                                     for sf in start_frames_jobs)
+        else:
+            outputs = [_accumulate_covariance(rec_arg, start_frames, chunk_size)]
+
+        # partial sums of the workers are merged
+        sum_traces = np.sum([out[0] for out in outputs], axis=0)
+        sum_products = np.sum([out[1] for out in outputs], axis=0)
+        num_samples = np.sum([out[2] for out in outputs])
+        mean = sum_traces / num_samples
+        return sum_products / num_samples - np.outer(mean, mean)
+
+    def _compute_random_covariance(self, seed):
+        return get_recording_stats(self._recording, seed=seed).get_covariance()
+
     def filter_chunk(self, start_frame, end_frame, channel_ids, return_scaled):
         assert return_scaled, "'whiten' only supports return_scaled=True"
 
         chan_idxs = np.array([self.get_channel_ids().index(chan) for chan in channel_ids])
+        if self._local_radius is not None:
+            # only the neighborhoods of the requested channels are read
+            operator = self._whitening_matrix[chan_idxs]
+            read_idxs = np.unique(operator.indices)
+            recording_channel_ids = self._recording.get_channel_ids()
+            chunk = self._recording.get_traces(channel_ids=[recording_channel_ids[i] for i in read_idxs],
+                                               start_frame=start_frame, end_frame=end_frame,
+                                               return_scaled=return_scaled)
+            chunk_centered = chunk - np.mean(chunk, axis=1, keepdims=True)
+            return operator[:, read_idxs] @ chunk_centered
         chunk = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame, return_scaled=return_scaled)
-        chunk = chunk - np.mean(chunk, axis=1, keepdims=True)
-        chunk2 = self._whitening_matrix @ chunk
+        chunk2 = self._do_filter(chunk)
         return chunk2[chan_idxs]
 
+    def _do_filter(self, chunk):
+        # 'chunk' contains all channels of the parent recording (the whitening matrix can be sparse)
+        chunk_centered = chunk - np.mean(chunk, axis=1, keepdims=True)
+        return (self._whitening_matrix @ chunk_centered).astype(chunk.dtype, copy=False)
+
+
+def _add_to_cache(key, W):
+    _whitening_matrix_cache[key] = W
+    while len(_whitening_matrix_cache) > _max_cached_matrices:
+        _whitening_matrix_cache.popitem(last=False)
+
+
+def _get_whitening_from_covariance(covariance):
+    # Original by Jeremy
+    U, S, Ut = np.linalg.svd(covariance, full_matrices=True)
+    W = (U @ np.diag(1 / np.sqrt(S))) @ Ut
+    return W
+
+
+def _get_local_whitening_from_covariance(covariance, neighborhoods):
+    # each channel is whitened with the covariance of its neighborhood only: the matrix is sparse
+    rows = []
+    cols = []
+    weights = []
+    for i, neighborhood in enumerate(neighborhoods):
+        W_local = _get_whitening_from_covariance(covariance[np.ix_(neighborhood, neighborhood)])
+        rows.append(np.full(len(neighborhood), i))
+        cols.append(neighborhood)
+        weights.append(W_local[list(neighborhood).index(i)])
+    num_channels = len(neighborhoods)
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(num_channels, num_channels))
+
+
+def _accumulate_covariance(rec_arg, start_frames, chunk_size):
+    if isinstance(rec_arg, dict):
+        recording = se.load_extractor_from_dict(rec_arg)
+    else:
+        recording = rec_arg
+    num_channels = recording.get_num_channels()
+    sum_traces = np.zeros(num_channels)
+    sum_products = np.zeros((num_channels, num_channels))
+    num_samples = 0
+    for start_frame in start_frames:
+        end_frame = min(start_frame + chunk_size, recording.get_num_frames())
+        traces = recording.get_traces(start_frame=start_frame, end_frame=end_frame).astype('float64')
+        sum_traces += np.sum(traces, axis=1)
+        sum_products += traces @ traces.T
+        num_samples += traces.shape[1]
+    return sum_traces, sum_products, num_samples
+
 
-def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
+def whiten(recording, chunk_size=30000, cache_chunks=False, cache_mb=None, cache_folder=None, seed=0,
+           fraction=None, local_radius=None, n_jobs=1, joblib_backend='loky'):
     '''
     Whitens the recording extractor traces.
 
@@ -56,10 +204,28 @@ def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
         The recording extractor to be whitened.
     chunk_size: int
         The chunk size to be used for the filtering.
-    cache_chunks: bool
-        If True, filtered traces are computed and cached all at once (default False).
+    cache_chunks: bool or 'shared'
+        If True, whitened chunks are cached in memory in a least-recently-used cache of 'cache_mb' Mb.
+        If 'shared', chunks are cached in the process-wide cache shared by all filter recordings (default False).
+    cache_mb: float or None
+        Memory budget in Mb of the chunk cache when cache_chunks is True (default 800 Mb)
+    cache_folder: str, Path, or None
+        If given, filtered chunks are also cached on disk in a sub-folder of 'cache_folder' identified by the hash of
+        the preprocessing chain, so that they are reused by other processes (the recording must be dumpable)
     seed: int
         Random seed for reproducibility
+    fraction: float or None
+        If None (default), the covariance is estimated on 50 random chunks of 500 samples. Otherwise, the covariance
+        is accumulated over chunks of 'chunk_size' evenly spaced over the recording and covering this fraction of it
+        (1 streams the whole recording). The whitening matrix is cached by preprocessing chain in the process and, if
+        'cache_folder' is given, on disk
+    local_radius: float or None
+        If given, each channel is whitened using only the channels within this radius (in the units of the channel
+        locations). The whitening matrix is sparse and only the neighborhoods of the requested channels are read
+    n_jobs: int
+        Number of parallel jobs to accumulate the covariance when 'fraction' is given (default 1)
+    joblib_backend: str
+        The backend for joblib (default 'loky')
     Returns
     -------
     whitened_recording: WhitenRecording
@@ -70,5 +236,11 @@ def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
         recording=recording,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
-        seed=seed
+        cache_mb=cache_mb,
+        cache_folder=cache_folder,
+        seed=seed,
+        fraction=fraction,
+        local_radius=local_radius,
+        n_jobs=n_jobs,
+        joblib_backend=joblib_backend
     )
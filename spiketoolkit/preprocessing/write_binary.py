@@ -0,0 +1,78 @@
+from spikeextractors.extraction_tools import write_to_binary_dat_format
+from pathlib import Path
+import spikeextractors as se
+import numpy as np
+import time
+
+
+def write_binary(recording, path, dtype=None, n_jobs=1, chunk_mb=500, chunk_size=None, time_axis=0,
+                 joblib_backend='loky', return_scaled=True, verbose=False):
+    '''
+    Writes the traces of a (lazy) recording extractor to a binary file, processing it in chunks, and returns
+    the recording extractor of the written file.
+
+    The traces are written with spikeextractors' write_to_binary_dat_format, which preallocates the file and
+    evaluates the preprocessing chain on 'n_jobs' processes that write their chunks in a memmap of the file.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to write
+    path: str or Path
+        Path of the binary file. If it has no suffix, '.dat' is added
+    dtype: dtype or None
+        Type of the saved data. If None, the dtype of the recording is used
+    n_jobs: int
+        Number of jobs for parallel writing
+    chunk_mb: int
+        Size of the chunks in Mb (default 500 Mb)
+    chunk_size: int or None
+        Size of the chunks in frames. If given, it overrides 'chunk_mb'
+    time_axis: int
+        If 0 (default), traces are saved as (num_frames x num_channels), if 1 as (num_channels x num_frames).
+        With 1, the traces are not chunked and are written at once
+    joblib_backend: str
+        The backend for joblib
+    return_scaled: bool
+        If True, the scaled traces are written
+    verbose: bool
+        If True, the writing speed is printed
+
+    Returns
+    -------
+    recording_binary: BinDatRecordingExtractor
+        The recording extractor of the written binary file
+    '''
+    assert time_axis in [0, 1], "'time_axis' can be 0 or 1"
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if dtype is None:
+        dtype = recording.get_dtype(return_scaled=return_scaled)
+    dtype = np.dtype(dtype)
+
+    t_start = time.perf_counter()
+    path = write_to_binary_dat_format(recording, save_path=path, time_axis=time_axis, dtype=dtype,
+                                      chunk_size=chunk_size, chunk_mb=chunk_mb, n_jobs=n_jobs,
+                                      joblib_backend=joblib_backend, return_scaled=return_scaled)
+    if verbose:
+        elapsed = time.perf_counter() - t_start
+        num_mb = recording.get_num_frames() * recording.get_num_channels() * dtype.itemsize / 1e6
+        print(f"Written {num_mb:.1f} MB in {elapsed:.2f} s ({num_mb / elapsed:.1f} MB/s) - "
+              f"Number of jobs: {n_jobs}")
+
+    if 'location' in recording.get_shared_channel_property_names():
+        geom = np.array(recording.get_channel_locations())
+    else:
+        geom = None
+    if return_scaled:
+        gain = None
+        channel_offset = None
+    else:
+        gain = recording.get_channel_gains()
+        channel_offset = recording.get_channel_offsets()
+    recording_binary = se.BinDatRecordingExtractor(path, sampling_frequency=recording.get_sampling_frequency(),
+                                                   numchan=recording.get_num_channels(), dtype=dtype.name,
+                                                   time_axis=time_axis,
+                                                   recording_channels=recording.get_channel_ids(), geom=geom,
+                                                   gain=gain, channel_offset=channel_offset)
+    return recording_binary
@@ -1,6 +1,7 @@
 from joblib import Parallel, delayed
 import spikeextractors as se
 from ..postprocessing.postprocessing_tools import divide_recording_into_time_chunks
+from ..preprocessing.recording_stats import get_recording_stats
 import itertools
 from tqdm import tqdm
 import numpy as np
@@ -121,9 +122,12 @@ def detect_spikes(recording, channel_ids=None, detect_threshold=5, detect_sign=-
     snippet_len = int(snippet_size_sec * recording.get_sampling_frequency())
     reference_frames = np.linspace(snippet_len+1, recording.get_num_frames() - snippet_len,
                                    n_snippets_for_threshold)
-    snippets = recording.get_snippets(reference_frames=reference_frames, snippet_len=snippet_len)
-    traces_mad = np.concatenate(snippets, 1)
-    thresholds = detect_threshold * np.median(np.abs(traces_mad) / 0.6745, 1)[:, None]
+    snippet_len_before = int((snippet_len + 1) / 2)
+    snippet_len_after = int(snippet_len - snippet_len_before)
+    frame_ranges = [(max(0, int(ref) - snippet_len_before), min(recording.get_num_frames(), int(ref) + snippet_len_after))
+                    for ref in reference_frames]
+    stats = get_recording_stats(recording, frame_ranges=frame_ranges)
+    thresholds = detect_threshold * stats.get_mad(centered=False)[:, None]
 
     if n_jobs > 1:
         output = Parallel(n_jobs=n_jobs, backend=joblib_backend)(delayed(_detect_and_align_peaks_chunk)
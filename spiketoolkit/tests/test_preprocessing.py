@@ -1,12 +1,19 @@
+import gc
 import numpy as np
 import spikeextractors as se
 import pytest
 import shutil
+from pathlib import Path
 from spiketoolkit.tests.utils import check_signal_power_signal1_below_signal2
 from spiketoolkit.preprocessing import bandpass_filter, blank_saturation, center, clip, common_reference, \
     highpass_filter, normalize_by_quantile, notch_filter, rectify, remove_artifacts, remove_bad_channels, resample, \
-    mask, transform, whiten
+    mask, transform, whiten, fuse, prefetch, get_recording_stats, get_quantile_sketch, write_binary, \
+    set_filter_threads, profile_preprocessing, TransformRecording, set_recording_stats_cache_mb, \
+    clear_recording_stats_cache
+from spiketoolkit.preprocessing.common_reference import _median_approximate
+from spiketoolkit.preprocessing.whiten import _whitening_matrix_cache
 from spikeextractors.testing import check_dumping
+from scipy.signal import resample_poly, sosfilt
 
 
 @pytest.mark.implemented
@@ -41,6 +48,12 @@ def test_bandpass_filter():
                                                     fs=rec.get_sampling_frequency())
     check_dumping(rec_sci)
 
+    rec_sci32 = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter', order=3,
+                                compute_dtype='float32')
+    assert np.allclose(rec_sci32.get_traces(), rec_sci.get_traces(), atol=1e-2)
+    rec_sci_high_order = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter', order=10)
+    assert np.all(np.isfinite(rec_sci_high_order.get_traces()))
+
     traces = rec.get_traces().astype('uint16')
     rec_u = se.NumpyRecordingExtractor(traces, sampling_frequency=rec.get_sampling_frequency())
     rec_fu = bandpass_filter(rec_u, freq_min=5000, freq_max=10000, filter_type='fft')
@@ -70,6 +83,97 @@ def test_bandpass_filter():
                                                     rec.get_traces(end_frame=30000), freq_range=[6000, 10000],
                                                     fs=rec.get_sampling_frequency())
     check_dumping(rec_no_chunk)
+
+    # padding from the impulse response
+    rec_butter = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter')
+    rec_butter_no_chunk = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter', chunk_size=None)
+    rec_butter_tol = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter', padding_tol=1e-8)
+    assert rec_butter._padding < rec_butter_tol._padding
+    assert np.allclose(rec_butter.get_traces(), rec_butter_no_chunk.get_traces(), atol=1e-2)
+    # each of the two passes of sosfiltfilt has an edge error below padding_tol * sum(|h|) * max(|x|)
+    impulse = np.zeros(30000)
+    impulse[0] = 1
+    for rec_chunk, rec_whole in [(rec_butter, rec_butter_no_chunk),
+                                 (highpass_filter(rec, freq_min=300), highpass_filter(rec, freq_min=300,
+                                                                                      chunk_size=None))]:
+        l1 = np.sum(np.abs(sosfilt(rec_chunk._sos, impulse)))
+        max_error = 2 * 1e-5 * l1 ** 2 * np.max(np.abs(rec.get_traces()))
+        assert np.max(np.abs(rec_chunk.get_traces() - rec_whole.get_traces())) < max_error
+
+    # chunk cache
+    rec_cache = bandpass_filter(rec, freq_min=3000, freq_max=6000, cache_chunks=True, cache_mb=10)
+    traces_sub = rec_cache.get_traces(channel_ids=[0, 1], end_frame=30000)
+    assert rec_cache.get_cache_stats()['misses'] == 1
+    assert np.array_equal(rec_cache.get_traces(channel_ids=[1], end_frame=30000), traces_sub[1:])
+    assert rec_cache.get_cache_stats()['hits'] == 1
+    assert np.allclose(rec_cache.get_traces(), rec_no_chunk.get_traces(), atol=1e-3)
+    assert rec_cache.get_cache_stats()['size_mb'] <= 10
+    check_dumping(rec_cache)
+
+    rec_shared = bandpass_filter(rec, freq_min=3000, freq_max=6000, cache_chunks='shared')
+    assert np.allclose(rec_shared.get_traces(), rec_no_chunk.get_traces(), atol=1e-3)
+    assert rec_shared.get_cache_stats()['size_mb'] > 0
+
+    # causal mode: sequential reads carry the filter state, random reads use the left padding
+    rec_causal = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter', causal=True,
+                                 chunk_size=10000)
+    traces_seq = np.hstack([rec_causal.get_traces(start_frame=s, end_frame=s + 10000) for s in range(0, 60000, 10000)])
+    rec_causal2 = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter', causal=True,
+                                  chunk_size=10000)
+    assert np.allclose(rec_causal2.get_traces(start_frame=30000, end_frame=40000), traces_seq[:, 30000:40000],
+                       atol=1e-3)
+    assert check_signal_power_signal1_below_signal2(traces_seq, rec.get_traces(), freq_range=[1000, 3000],
+                                                    fs=rec.get_sampling_frequency())
+    rec_zero_phase = bandpass_filter(rec, freq_min=3000, freq_max=6000, filter_type='butter')
+    assert not np.allclose(rec_zero_phase.get_traces(), traces_seq, atol=1e-3)
+    check_dumping(rec_causal)
+
+    # random reads start from the steady state: an offset does not produce a start-up transient
+    rec_offset = se.NumpyRecordingExtractor(timeseries=np.random.RandomState(0).randn(4, 60000) * 20 + 500,
+                                            sampling_frequency=rec.get_sampling_frequency())
+    rec_causal_offset = bandpass_filter(rec_offset, freq_min=300, freq_max=6000, filter_type='butter', causal=True,
+                                        chunk_size=None)
+    traces_seq = np.hstack([rec_causal_offset.get_traces(start_frame=s, end_frame=s + 10000)
+                            for s in range(0, 60000, 10000)])
+    rec_causal_offset2 = bandpass_filter(rec_offset, freq_min=300, freq_max=6000, filter_type='butter', causal=True,
+                                         chunk_size=None)
+    assert np.allclose(rec_causal_offset2.get_traces(start_frame=30000, end_frame=40000),
+                       traces_seq[:, 30000:40000], atol=5e-3)
+
+    # disk cache is shared by recordings with the same preprocessing chain
+    rec_disk = bandpass_filter(rec, freq_min=3000, freq_max=6000, cache_folder='test/cache')
+    traces_disk = rec_disk.get_traces()
+    assert rec_disk.get_cache_stats()['disk_misses'] == 2
+    rec_disk2 = bandpass_filter(rec, freq_min=3000, freq_max=6000, cache_chunks=True, cache_folder='test/cache')
+    assert np.array_equal(rec_disk2.get_traces(channel_ids=[2, 3]), traces_disk[2:])
+    assert rec_disk2.get_cache_stats()['disk_hits'] == 2
+    rec_disk3 = bandpass_filter(rec, freq_min=300, freq_max=6000, cache_folder='test/cache')
+    rec_disk3.get_traces(end_frame=100)
+    assert rec_disk3.get_cache_stats()['disk_misses'] == 1
+    check_dumping(rec_disk)
+
+    # chunks spanned by one call are filtered concurrently
+    rec_threads = bandpass_filter(rec, freq_min=3000, freq_max=6000, chunk_size=7000, cache_chunks=True)
+    rec_threads.set_n_threads(3)
+    rec_serial = bandpass_filter(rec, freq_min=3000, freq_max=6000, chunk_size=7000)
+    assert np.array_equal(rec_threads.get_traces(start_frame=1000, end_frame=50000),
+                          rec_serial.get_traces(start_frame=1000, end_frame=50000))
+    assert rec_threads.get_cache_stats()['misses'] == 8
+    try:
+        set_filter_threads(2)
+        rec_nested = bandpass_filter(rec_serial, freq_min=3000, freq_max=6000, chunk_size=10000)
+        rec_nested_serial = bandpass_filter(rec_serial, freq_min=3000, freq_max=6000, chunk_size=10000)
+        rec_nested_serial.set_n_threads(1)
+        assert np.array_equal(rec_nested.get_traces(), rec_nested_serial.get_traces())
+    finally:
+        set_filter_threads(1)
+
+    # a recording rewritten at the same path does not read the cached chunks of the previous one
+    rec_new, _ = se.example_datasets.toy_example(dump_folder='test', dumpable=True, duration=2, num_channels=4,
+                                                 seed=1)
+    rec_disk4 = bandpass_filter(rec_new, freq_min=3000, freq_max=6000, cache_folder='test/cache')
+    rec_disk4.get_traces(end_frame=100)
+    assert rec_disk4.get_cache_stats()['disk_misses'] == 1
     shutil.rmtree('test')
 
 
@@ -84,6 +188,11 @@ def test_blank_saturation():
     assert np.all(rec_bs.get_traces()[index_below_threshold] < threshold)
 
     check_dumping(rec_bs)
+
+    rec_bs_full = blank_saturation(rec, full_pass=True, n_jobs=2)
+    q = np.quantile(rec.get_traces(), [0.001, 0.999])
+    assert np.min(np.abs(q - rec_bs_full._threshold)) < 0.01 * np.max(np.abs(q))
+    check_dumping(rec_bs_full)
     shutil.rmtree('test')
 
 
@@ -142,6 +251,26 @@ def test_common_reference():
 
     assert 'int16' in str(rec_cmr_int16.get_dtype())
 
+    # median kernels
+    rec_cmr_part = common_reference(rec, reference='median', median_kernel='partition')
+    rec_cmr_approx = common_reference(rec, reference='median', median_kernel='approximate', median_tol=0.1)
+    rec_cmr_trim = common_reference(rec, reference='median', median_kernel='trimmed_mean')
+    assert np.allclose(rec_cmr_part.get_traces(), rec_cmr.get_traces(), atol=0.01)
+    # with an even number of channels, any value between the two middle values is a median
+    sorted_traces = np.sort(traces, axis=0)
+    approx_median = traces - rec_cmr_approx.get_traces()
+    assert np.all(approx_median >= sorted_traces[1] - 0.1 - 1e-3)
+    assert np.all(approx_median <= sorted_traces[2] + 0.1 + 1e-3)
+    assert rec_cmr_trim.get_traces().shape == traces.shape
+    check_dumping(rec_cmr_approx)
+    # a tolerance below the float32 spacing of large-offset data is reached in a bounded number of steps
+    rs = np.random.RandomState(0)
+    offset_traces = (rs.randn(64, 100) * 100 + 1000).astype('float32')
+    approx_median = _median_approximate(offset_traces, 1e-5)[0]
+    sorted_traces = np.sort(offset_traces, axis=0)
+    assert np.all(approx_median >= sorted_traces[31] - 1e-3)
+    assert np.all(approx_median <= sorted_traces[32] + 1e-3)
+
     # test groups
     groups = [[0, 1], [2, 3]]
     rec_cmr_g = common_reference(rec, reference='median', groups=groups)
@@ -159,6 +288,8 @@ def test_common_reference():
     assert np.allclose(rec_sin_g.get_traces()[1], traces[1] - traces[0])
     assert not np.all(rec_sin_g.get_traces()[2])
     assert np.allclose(rec_sin_g.get_traces()[3], traces[3] - traces[2])
+    assert np.allclose(rec_sin_g.get_traces(channel_ids=[3]), traces[3] - traces[2])
+    assert np.allclose(rec_cmr_g.get_traces(channel_ids=[0, 3]), rec_cmr_g.get_traces()[[0, 3]])
     assert 'int16' in str(rec_cmr_int16_g.get_dtype())
 
     check_dumping(rec_cmr)
@@ -182,6 +313,58 @@ def test_common_reference():
     assert np.allclose(traces[3], rec_local_car2.get_traces()[3] + np.mean(traces[[0, 6, 7]], axis=0, keepdims=True),
                        atol=0.01)
 
+    # neighbors are channel indices: non-contiguous channel ids are referenced to the same channels
+    rec_ids = se.SubRecordingExtractor(rec2, renamed_channel_ids=[2, 5, 7, 11, 13, 17, 19, 23])
+    rec_local_car_ids = common_reference(rec_ids, reference='local', local_radius=(2, 4))
+    assert np.allclose(traces[3], rec_local_car_ids.get_traces(channel_ids=[11])[0] +
+                       np.mean(traces[[0, 6, 7]], axis=0), atol=0.01)
+    assert np.allclose(rec_local_car_ids.get_traces(), rec_local_car2.get_traces())
+
+    shutil.rmtree('test')
+
+
+@pytest.mark.implemented
+def test_fuse():
+    rec, sort = se.example_datasets.toy_example(dump_folder='test', dumpable=True, duration=2, num_channels=4, seed=0)
+
+    # with the chunk grid of the stages, the fused traces are those of the non-fused chain
+    rec_chain = whiten(common_reference(bandpass_filter(rec, freq_min=300, freq_max=6000)))
+    rec_fused = fuse(rec_chain)
+    assert rec_fused.get_fused_stages() == ['BandpassFilter', 'CommonReference', 'Whiten']
+    assert np.allclose(rec_fused.get_traces(), rec_chain.get_traces(), rtol=0, atol=1e-5)
+    assert np.allclose(rec_fused.get_traces(channel_ids=[1, 2], start_frame=1000, end_frame=40000),
+                       rec_chain.get_traces(channel_ids=[1, 2], start_frame=1000, end_frame=40000), rtol=0, atol=1e-5)
+    # the whitening is fused on its own chunks
+    assert np.allclose(fuse(rec_chain, chunk_size=None).get_traces(), rec_chain.get_traces(), rtol=0, atol=1e-5)
+
+    rec_chain = notch_filter(rec, freq=3000, q=30)
+    assert np.allclose(fuse(rec_chain).get_traces(), rec_chain.get_traces(), rtol=0, atol=1e-5)
+
+    # a whitening before other stages is read as a source
+    rec_chain = bandpass_filter(whiten(rec), freq_min=300, freq_max=6000)
+    rec_fused = fuse(rec_chain)
+    assert rec_fused.get_fused_stages() == ['BandpassFilter']
+    assert np.allclose(rec_fused.get_traces(), rec_chain.get_traces(), rtol=0, atol=1e-5)
+
+    # on other chunks, the traces differ by the filter edge effects (bounded by 'padding_tol' of the amplitude)
+    rec_chain = common_reference(bandpass_filter(rec, freq_min=300, freq_max=6000))
+    traces = rec_chain.get_traces()
+    traces_fused = fuse(rec_chain, chunk_size=None).get_traces()
+    assert np.max(np.abs(traces_fused - traces)) < 1e-4 * np.max(np.abs(traces))
+
+    rec_chain = clip(transform(highpass_filter(rec, freq_min=300), scalar=2, offset=1), a_min=-5, a_max=5)
+    rec_fused = fuse(rec_chain)
+    assert np.allclose(rec_fused.get_traces(), rec_chain.get_traces(), rtol=0, atol=1e-5)
+
+    # integer outputs of the stages are truncated as in the non-fused chain
+    rec_int16 = se.NumpyRecordingExtractor(timeseries=(50 * rec.get_traces()).astype('int16'),
+                                           sampling_frequency=rec.get_sampling_frequency())
+    rec_int16.set_channel_locations(rec.get_channel_locations())
+    rec_chain = common_reference(bandpass_filter(rec_int16, freq_min=300, freq_max=6000))
+    assert rec_chain.get_dtype() == 'int16'
+    assert np.array_equal(fuse(rec_chain).get_traces(), rec_chain.get_traces())
+
+    check_dumping(rec_fused)
     shutil.rmtree('test')
 
 
@@ -237,6 +420,126 @@ def test_notch_filter():
                                                     fs=rec.get_sampling_frequency())
 
     check_dumping(rec_n)
+
+    # harmonics removed in one pass, as with stacked notch filters
+    rec_multi = notch_filter(rec, freq=[2000, 4000, 6000], q=[10, 20, 30])
+    rec_stacked = notch_filter(notch_filter(notch_filter(rec, 2000, q=10), 4000, q=20), 6000, q=30)
+    for freq in [2000, 4000, 6000]:
+        assert check_signal_power_signal1_below_signal2(rec_multi.get_traces(), rec.get_traces(),
+                                                        freq_range=[freq - 100, freq + 100],
+                                                        fs=rec.get_sampling_frequency())
+    # filters commute away from the recording edges
+    assert np.allclose(rec_multi.get_traces()[:, 5000:-5000], rec_stacked.get_traces()[:, 5000:-5000], atol=1e-2)
+    check_dumping(rec_multi)
+    shutil.rmtree('test')
+
+
+@pytest.mark.implemented
+def test_prefetch():
+    rec, sort = se.example_datasets.toy_example(dump_folder='test', dumpable=True, duration=2, num_channels=4, seed=0)
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000)
+    rec_p = prefetch(rec_f, n_prefetch=2)
+
+    traces = np.hstack([rec_p.get_traces(start_frame=s, end_frame=s + 7000) for s in range(0, 60000, 7000)])
+    assert np.array_equal(traces, rec_f.get_traces())
+    assert rec_p.get_prefetch_stats() == {'hits': 8, 'misses': 1}
+
+    assert np.array_equal(rec_p.get_traces(channel_ids=[1, 2], start_frame=100, end_frame=200),
+                          rec_f.get_traces(channel_ids=[1, 2], start_frame=100, end_frame=200))
+    assert rec_p.get_prefetch_stats()['misses'] == 2
+    check_dumping(rec_p)
+    shutil.rmtree('test')
+
+
+@pytest.mark.implemented
+def test_profiling():
+    rec, sort = se.example_datasets.toy_example(dump_folder='test', dumpable=True, duration=2, num_channels=4, seed=0)
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, cache_chunks=True)
+    rec_cmr = common_reference(rec_f)
+
+    with profile_preprocessing() as profiler:
+        rec_cmr.get_traces(end_frame=30000)
+        rec_cmr.get_traces(channel_ids=[0, 1], end_frame=30000)
+    rec_cmr.get_traces()
+
+    stats_cmr = profiler.get_stats(rec_cmr)
+    stats_f = profiler.get_stats(rec_f)
+    assert stats_cmr['calls'] == 2 and stats_f['calls'] == 2
+    assert stats_cmr['samples'] == 6 * 30000
+    assert stats_f['cache_hits'] == 1
+    report = profiler.get_report(rec_cmr).split('\n')
+    assert len(report) == 3
+    assert report[0].startswith('CommonReference: 2 calls') and report[1].startswith('└─ BandpassFilter: 2 calls')
+    assert list(profiler.get_stats().keys()) == ['BandpassFilter', 'CommonReference']
+
+    # the statistics of a collected recording are not inherited by a new recording with the same id
+    rec_t = transform(rec, scalar=2)
+    with profile_preprocessing() as profiler:
+        rec_t.get_traces()
+        del rec_t
+        gc.collect()
+        rec_t2 = transform(rec, scalar=2)
+        assert profiler.get_stats(rec_t2)['calls'] == 0
+        assert profiler.get_stats()['Transform']['calls'] == 1
+
+    # calls of the filter threads are counted as calls of the filter
+    rec_f = bandpass_filter(transform(rec, scalar=2), freq_min=300, freq_max=6000, chunk_size=10000)
+    rec_f.set_n_threads(2)
+    with profile_preprocessing() as profiler:
+        rec_f.get_traces()
+    assert profiler.get_stats(rec_f)['calls'] == 1
+    assert profiler.get_stats(rec_f._recording)['calls'] == 6
+    assert profiler.get_stats(rec_f)['time'] >= 0
+    shutil.rmtree('test')
+
+
+@pytest.mark.implemented
+def test_recording_stats():
+    rec, sort = se.example_datasets.toy_example(dump_folder='test', dumpable=True, duration=2, num_channels=4, seed=0)
+
+    stats = get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0)
+    random_ints = np.random.RandomState(seed=0).randint(0, rec.get_num_frames() - 100, size=10)
+    traces = np.concatenate([rec.get_traces(start_frame=ff, end_frame=ff + 100) for ff in random_ints], axis=1)
+
+    assert stats.get_num_samples() == 1000
+    assert np.allclose(stats.get_std(), np.std(traces, axis=1))
+    assert np.allclose(stats.get_median(), np.median(traces, axis=1))
+    assert np.allclose(stats.get_mad(), np.median(np.abs(traces - np.median(traces, 1, keepdims=True)) / 0.6745, 1))
+    assert np.allclose(stats.get_quantiles([0.1, 0.9]), np.quantile(traces, [0.1, 0.9]))
+    assert np.allclose(stats.get_quantiles([0.1, 0.9], pooled=False), np.quantile(traces, [0.1, 0.9], axis=1))
+    assert np.allclose(stats.get_covariance(), np.cov(traces, bias=True))
+
+    # the sample of the same chain is read only once
+    assert get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0) is stats
+    assert get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=1) is not stats
+    stats_par = get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=1, n_jobs=2)
+    assert stats_par.get_num_samples() == 1000
+    assert get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0, use_cache=False) is not stats
+
+    # samples above the memory budget of the cache are not kept
+    try:
+        set_recording_stats_cache_mb(stats.get_nbytes() / 1e6 / 2)
+        assert get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0) is not stats
+        stats_2 = get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0)
+        assert get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0) is not stats_2
+    finally:
+        set_recording_stats_cache_mb(100)
+    stats = get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0)
+    clear_recording_stats_cache()
+    assert get_recording_stats(rec, num_chunks=10, chunk_size=100, seed=0) is not stats
+
+    # full pass quantile sketches of the chunks are merged
+    sketch = get_quantile_sketch(rec, chunk_size=5000, n_jobs=2)
+    q = [0.001, 0.01, 0.5, 0.99, 0.999]
+    assert sketch.count == rec.get_num_frames() * rec.get_num_channels()
+    assert np.allclose(sketch.get_quantiles(q), np.quantile(rec.get_traces(), q), rtol=0.01, atol=1e-3)
+
+    # integer data: quantiles are interpolated between adjacent ranks as np.quantile
+    traces_int = np.arange(-5, 6, dtype='int16')[np.newaxis]
+    rec_int = se.NumpyRecordingExtractor(timeseries=traces_int, sampling_frequency=30000)
+    sketch_int = get_quantile_sketch(rec_int, chunk_size=5000)
+    assert np.allclose(sketch_int.get_quantiles(q), np.quantile(traces_int, q), rtol=0.01, atol=1e-3)
+
     shutil.rmtree('test')
 
 
@@ -248,6 +551,18 @@ def test_rectify():
 
     assert np.allclose(rec_rect.get_traces(), np.abs(rec.get_traces()))
 
+    # unscaled traces are not read through a transform stage, which only supports scaled traces
+    rec_unscaled = se.NumpyRecordingExtractor(timeseries=rec.get_traces(), sampling_frequency=30000)
+    rec_unscaled.has_unscaled = True
+    rec_unscaled.set_channel_gains(2)
+    rec_rect_t = rectify(transform(rec_unscaled, scalar=3))
+    with pytest.warns(UserWarning):
+        traces_unscaled = rec_rect_t.get_traces(return_scaled=False)
+    assert np.allclose(traces_unscaled, rec_rect_t.get_traces())
+    # also when the stage above the transform is given unscaled traces
+    rec_rect_t.has_unscaled = True
+    assert np.allclose(rec_rect_t.get_traces(return_scaled=False), 6 * np.abs(rec.get_traces()), atol=1e-4)
+
     check_dumping(rec_rect)
     shutil.rmtree('test')
 
@@ -285,6 +600,21 @@ def test_remove_artifacts():
     assert not np.allclose(traces_all_0, traces_all_0_clean)
     assert not np.allclose(traces_all_1, traces_all_1_clean)
 
+    # many triggers: gaps are interpolated in batch, also for close triggers and at the edges of the window
+    ramp = np.tile(np.arange(30000, dtype='float64'), (2, 1))
+    rec_ramp = se.NumpyRecordingExtractor(ramp, sampling_frequency=rec.get_sampling_frequency())
+    triggers_many = list(np.arange(200, 29000, 500)) + [10050, 10150]
+    traces_ramp = ramp.copy()
+    for trig in triggers_many:
+        traces_ramp[:, trig - 15:trig + 90] = 0
+    rec_rmart_many = remove_artifacts(rec_ramp, triggers_many, mode='zeros')
+    assert np.array_equal(rec_rmart_many.get_traces(), traces_ramp)
+    rec_rmart_many_lin = remove_artifacts(rec_ramp, triggers_many, mode='linear')
+    # fit values are medians of a few samples around the fit points (off-centre next to the gap)
+    assert np.allclose(rec_rmart_many_lin.get_traces(), ramp, atol=5)
+    assert np.allclose(rec_rmart_many_lin.get_traces(start_frame=10100, end_frame=10300), ramp[:, 10100:10300],
+                       atol=5)
+
     check_dumping(rec_rmart)
     shutil.rmtree('test')
 
@@ -321,6 +651,27 @@ def test_remove_bad_channels():
     check_dumping(rec_rm)
     shutil.rmtree('test')
 
+    # shared signal on all channels, with a noisy (1), a dead (3) and a disconnected (5) channel
+    rs = np.random.RandomState(0)
+    shared = rs.randn(1, 60000)
+    timeseries = shared + 0.5 * rs.randn(8, 60000)
+    timeseries[1] = 10 * rs.randn(60000)
+    timeseries[3] = 0
+    timeseries[5] = rs.randn(60000)
+    rec_np = se.NumpyRecordingExtractor(timeseries=timeseries, sampling_frequency=30000)
+    rec_np.set_channel_locations(np.array([[0, 10 * i] for i in range(8)]))
+    se.MdaRecordingExtractor.write_recording(rec_np, 'test')
+    rec = se.MdaRecordingExtractor('test')
+    rec_rm = remove_bad_channels(rec, bad_channel_ids=None, method='features', n_segments=4, local_radius=25,
+                                 n_jobs=2)
+    assert rec_rm.get_channel_ids() == [0, 2, 4, 6, 7]
+    assert rec_rm.bad_channel_features['neighbor_corr'][5] < 0.1
+    check_dumping(rec_rm)
+
+    rec_rm = remove_bad_channels(rec, bad_channel_ids=None, method='features', n_segments=4)
+    assert rec_rm.get_channel_ids() == [0, 2, 4, 5, 6, 7]
+    shutil.rmtree('test')
+
 
 @pytest.mark.implemented
 def test_resample():
@@ -335,6 +686,24 @@ def test_resample():
     assert rec_rsl.get_num_frames() == int(rec.get_num_frames() * 0.1)
     assert rec_rsh.get_num_frames() == int(rec.get_num_frames() * 2)
 
+    # chunked polyphase resampling does not depend on the requested window
+    traces_rsl = rec_rsl.get_traces()
+    assert np.allclose(rec_rsl.get_traces(start_frame=1234, end_frame=4321), traces_rsl[:, 1234:4321])
+    assert np.allclose(traces_rsl, resample_poly(rec.get_traces(), 1, 10, axis=1), atol=1e-3)
+    rec_rsl_no_chunk = resample(rec, resample_rate_low, chunk_size=None)
+    assert np.allclose(rec_rsl_no_chunk.get_traces(start_frame=100, end_frame=200), traces_rsl[:, 100:200], atol=1e-3)
+    rec_rs_same = resample(rec, rec.get_sampling_frequency())
+    assert np.allclose(rec_rs_same.get_traces(start_frame=1234, end_frame=40000),
+                       rec.get_traces(start_frame=1234, end_frame=40000))
+
+    # the sampling frequency and number of frames are those of the approximated ratio
+    with pytest.warns(UserWarning):
+        rec_rs_approx = resample(rec, 12345.6)
+    fs_approx = rec.get_sampling_frequency() * rec_rs_approx._up / rec_rs_approx._down
+    assert rec_rs_approx.get_sampling_frequency() == fs_approx
+    assert rec_rs_approx.get_num_frames() == int(rec.get_num_frames() / rec.get_sampling_frequency() * fs_approx)
+    assert rec_rs_approx.get_traces().shape[1] == rec_rs_approx.get_num_frames()
+
     # with times
 
     times = rec.frame_to_time(np.arange(rec.get_num_frames())) - 10
@@ -370,6 +739,29 @@ def test_transform():
 
     check_dumping(rec_t)
     check_dumping(rec_t_arr)
+
+    # stacked element-wise stages are applied in place on the consumer buffer
+    rec_chain = rectify(clip(transform(transform(rec, scalar=scalars, offset=offsets), scalar=2, offset=1),
+                             a_min=-5, a_max=5))
+    traces = rec.get_traces(start_frame=100, end_frame=1100)
+    expected = np.abs(np.clip((scalars[:, None] * traces + offsets[:, None]) * 2 + 1, -5, 5))
+    out = np.empty((4, 1000), dtype=rec_chain.get_dtype())
+    assert rec_chain.get_traces(start_frame=100, end_frame=1100, out=out) is out
+    assert np.allclose(out, expected, atol=1e-4)
+    assert np.allclose(rec_chain.get_traces(start_frame=100, end_frame=1100), expected, atol=1e-4)
+    assert np.array_equal(rec.get_traces(start_frame=100, end_frame=1100), traces)
+
+    rec_int = TransformRecording(rec, scalar=10, dtype='int16')
+    assert np.array_equal(clip(rec_int, a_min=-20.5).get_traces(),
+                          np.clip((10 * rec.get_traces()).astype('int16'), -20, None))
+    # integer outputs that overflow wrap as when the stages are applied one by one
+    rec_uint16 = se.NumpyRecordingExtractor(timeseries=np.random.RandomState(0).randint(0, 60000, size=(4, 1000))
+                                            .astype('uint16'), sampling_frequency=30000)
+    traces_uint16 = rec_uint16.get_traces()
+    expected = (np.array([1.5, 2, 3, 4])[:, None] * traces_uint16 + 1).astype('uint16')
+    expected = (0.5 * expected - 2).astype('uint16')
+    rec_uint16_t = transform(transform(rec_uint16, scalar=[1.5, 2, 3, 4], offset=1), scalar=0.5, offset=-2)
+    assert np.array_equal(rec_uint16_t.get_traces(), expected)
     shutil.rmtree('test')
 
 
@@ -386,7 +778,48 @@ def test_whiten():
 
     assert np.array_equal(rec_w.get_traces(), rec_w2.get_traces())
 
+    # covariance streamed over the recording in parallel and whitening matrix cached by chain
+    rec_wf = whiten(rec, fraction=1, n_jobs=2, cache_folder='test/cache')
+    cov_wf = np.cov(rec_wf.get_traces())
+    assert np.allclose(cov_wf, np.eye(4), atol=0.05)
+    assert len(list(Path('test/cache').glob('whitening_*.npy'))) == 1
+    rec_wf2 = whiten(rec, fraction=1)
+    assert np.array_equal(rec_wf._whitening_matrix, rec_wf2._whitening_matrix)
+    rec_wf_half = whiten(rec, fraction=0.5)
+    assert np.allclose(rec_wf_half._whitening_matrix, rec_wf._whitening_matrix, atol=0.1)
+    # the least recently used matrices are evicted
+    for seed in range(10):
+        whiten(rec, seed=seed)
+    assert len(_whitening_matrix_cache) == 8
+
+    # local whitening reads only the neighborhoods of the requested channels
+    rec_wl = whiten(rec, local_radius=1.5, fraction=1)
+    assert rec_wl._whitening_matrix.nnz == 10
+    assert np.allclose(np.diag(np.cov(rec_wl.get_traces())), 1, atol=0.05)
+    assert np.allclose(rec_wl.get_traces(channel_ids=[2]), rec_wl.get_traces()[2:3])
+    rec_wl_all = whiten(rec, local_radius=100, fraction=1)
+    assert np.allclose(rec_wl_all.get_traces(), rec_wf.get_traces(), atol=1e-5)
+
     check_dumping(rec_w)
+    check_dumping(rec_wf)
+    check_dumping(rec_wl)
+    shutil.rmtree('test')
+
+
+@pytest.mark.implemented
+def test_write_binary():
+    rec, sort = se.example_datasets.toy_example(dump_folder='test', dumpable=True, duration=2, num_channels=4, seed=0)
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000)
+
+    rec_bin = write_binary(rec_f, 'test/filtered.dat', chunk_size=7000, n_jobs=2, verbose=True)
+    assert rec_bin.get_channel_ids() == rec.get_channel_ids()
+    assert np.allclose(rec_bin.get_traces(), rec_f.get_traces(), atol=1e-4)
+    assert np.allclose(rec_bin.get_channel_locations(), rec.get_channel_locations())
+
+    rec_bin = write_binary(rec_f, 'test/filtered_int16.dat', dtype='int16', time_axis=1)
+    assert rec_bin.get_dtype() == 'int16'
+    assert np.array_equal(rec_bin.get_traces(), rec_f.get_traces().astype('int16'))
+    check_dumping(rec_bin)
     shutil.rmtree('test')
 
 
@@ -401,12 +834,20 @@ if __name__ == '__main__':
     test_center()
     print("cmr")
     test_common_reference()
+    print("fuse")
+    test_fuse()
     print("mask")
     test_mask()
     print("norm by quantile")
     test_norm_by_quantile()
     print("notch")
     test_notch_filter()
+    print("prefetch")
+    test_prefetch()
+    print("profiling")
+    test_profiling()
+    print("recording stats")
+    test_recording_stats()
     print("rectify")
     test_rectify()
     print("remove artifacts")
@@ -419,3 +860,5 @@ if __name__ == '__main__':
     test_transform()
     print("whiten")
     test_whiten()
+    print("write binary")
+    test_write_binary()
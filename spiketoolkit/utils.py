@@ -1,4 +1,7 @@
 import numpy as np
+import hashlib
+import json
+from pathlib import Path
 
 
 def get_closest_channels(recording, channel_ids, num_channels=None):
@@ -38,3 +41,76 @@ def get_closest_channels(recording, channel_ids, num_channels=None):
         dist.append(np.sort(distances)[1:num_channels])
 
     return np.array(closest_channels_id), np.array(dist)
+
+
+def get_recording_hash(recording, ignore_kwargs=None):
+    """Computes a stable hash of the chain of extractors that produces the recording
+
+    The size and modification time of the files and folders read by the chain (e.g. 'file_path' or 'folder_path')
+    are hashed too, so that a file rewritten at the same path gives a different hash.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The (dumpable) recording extractor
+    ignore_kwargs: list or None
+        Names of kwargs that do not affect the traces (e.g. caching options) and are ignored at all levels of the chain
+
+    Returns
+    -------
+    hash: str
+        The hexadecimal sha1 hash of the serialized chain
+    """
+    assert recording.check_if_dumpable(), "The recording must be dumpable to compute its hash"
+    if ignore_kwargs is None:
+        ignore_kwargs = []
+    dump_dict = _remove_kwargs(recording.make_serialized_dict(), ignore_kwargs)
+    dump_str = json.dumps(dump_dict, sort_keys=True, default=_to_json)
+    files_str = json.dumps(_get_file_stats(dump_dict))
+    return hashlib.sha1((dump_str + files_str).encode()).hexdigest()
+
+
+def _remove_kwargs(d, ignore_kwargs):
+    if isinstance(d, dict):
+        return {k: _remove_kwargs(v, ignore_kwargs) for k, v in d.items() if k not in ignore_kwargs}
+    elif isinstance(d, (list, tuple)):
+        return [_remove_kwargs(v, ignore_kwargs) for v in d]
+    else:
+        return d
+
+
+def _get_file_stats(d):
+    # (path, size, modification time) of the existing files in the kwargs (and of the direct content of folders)
+    stats = []
+    if isinstance(d, dict):
+        for k in sorted(d.keys(), key=str):
+            stats += _get_file_stats(d[k])
+    elif isinstance(d, (list, tuple)):
+        for v in d:
+            stats += _get_file_stats(v)
+    elif isinstance(d, (str, Path)) and len(str(d)) > 0:
+        path = Path(d)
+        try:
+            if path.is_file():
+                stats.append(_get_path_stats(path))
+            elif path.is_dir():
+                stats += [_get_path_stats(p) for p in sorted(path.iterdir()) if p.is_file()]
+        except OSError:
+            pass
+    return stats
+
+
+def _get_path_stats(path):
+    stat = path.stat()
+    return [str(path.absolute()), stat.st_size, stat.st_mtime_ns]
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, Path):
+        return str(obj.absolute())
+    else:
+        return str(obj)
@@ -2,6 +2,7 @@ import numpy as np
 from .utils.thresholdcurator import ThresholdCurator
 from .quality_metric import QualityMetric
 import spiketoolkit as st
+from spiketoolkit.preprocessing import get_recording_stats
 from spikemetrics.utils import printProgressBar
 from collections import OrderedDict
 from .parameter_dictionaries import update_all_param_dicts_with_kwargs
@@ -108,21 +109,12 @@ def _compute_channel_noise_levels(recording, mode, noise_duration, seed):
     moise_levels: list
         Noise levels for each channel
     """
-    M = recording.get_num_channels()
     n_frames = int(noise_duration * recording.get_sampling_frequency())
-
-    if n_frames >= recording.get_num_frames():
-        start_frame = 0
-        end_frame = recording.get_num_frames()
-    else:
-        start_frame = np.random.RandomState(seed=seed).randint(0, recording.get_num_frames() - n_frames)
-        end_frame = start_frame + n_frames
-
-    X = recording.get_traces(start_frame=start_frame, end_frame=end_frame)
+    stats = get_recording_stats(recording, num_chunks=1, chunk_size=n_frames, seed=seed)
     if mode == "std":
-        noise_levels = np.std(X, 1)
+        noise_levels = stats.get_std()
     elif mode == "mad":
-        noise_levels = np.median(np.abs(X - np.median(X, 1, keepdims=True)) / 0.6745, 1)
+        noise_levels = stats.get_mad()
     else:
         raise Exception("'mode' can be 'std' or 'mad'")
     return noise_levels